@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import hashlib
+import hmac
+import ipaddress
+import os
+import queue
+import secrets
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from Config import Config
+from Errors import CraftMasterError
+from FileLock import fileLock
+from Server import readMessages, sendMessage
+
+# the shared secret of the coordinator and its agents
+KEY_VARIABLE = "CRAFTMASTER_AGENT_KEY"
+
+
+def _digest(key, nonce):
+    return hmac.new(
+        (key or "").encode("utf-8"), nonce.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def _isLoopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def _answerChallenge(stream, key):
+    """Answer the challenge of an agent, raises ConnectionError if it refuses key."""
+    try:
+        challenge = next(readMessages(stream))
+        sendMessage(
+            stream, {"type": "auth", "digest": _digest(key, challenge["nonce"])}
+        )
+        answer = next(readMessages(stream))
+    except (StopIteration, KeyError, TypeError):
+        raise ConnectionError("connection closed during the authentication")
+    if answer.get("type") != "authenticated":
+        raise ConnectionError(answer.get("message", "authentication failed"))
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def _challenge(self):
+        """Challenge the coordinator to prove that it knows the key of the agent."""
+        nonce = secrets.token_hex(32)
+        sendMessage(self.wfile, {"type": "challenge", "nonce": nonce})
+        try:
+            digest = str(next(readMessages(self.rfile))["digest"])
+        except (StopIteration, ValueError, KeyError, TypeError):
+            return False
+        if not hmac.compare_digest(digest, _digest(self.server.key, nonce)):
+            sendMessage(
+                self.wfile, {"type": "error", "message": "authentication failed"}
+            )
+            return False
+        sendMessage(self.wfile, {"type": "authenticated"})
+        return True
+
+    def handle(self):
+        if not self._challenge():
+            return
+        lock = threading.Lock()
+
+        def output(line):
+            with lock:
+                sendMessage(self.wfile, {"type": "output", "line": line})
+
+        for job in readMessages(self.rfile):
+            start = time.monotonic()
+            try:
+                code = self.server.runJob(job, output)
+            except CraftMasterError as e:
+                output(str(e))
+                code = 1
+            except Exception as e:
+                output(f"Job failed: {e}")
+                code = 1
+            sendMessage(
+                self.wfile,
+                {
+                    "type": "exit",
+                    "code": code or 0,
+                    "duration": time.monotonic() - start,
+                },
+            )
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Builds the targets a coordinator sends, see dispatch.
+
+    A job contains the resolved config, the targets and the commands. The
+    coordinator has to know key, which is required unless the agent only
+    listens on a loopback address.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, createMaster, key=None):
+        if not key and not _isLoopback(address[0]):
+            raise CraftMasterError(
+                f"A build agent listening on {address[0] or 'all addresses'} "
+                f"requires a key, please set {KEY_VARIABLE}"
+            )
+        self.key = key
+        self.createMaster = createMaster
+        self._lock = threading.Lock()
+        self._setupLocks = {}
+        super().__init__(address, AgentHandler)
+
+    def runJob(self, job, output):
+        # Config accepts keys without a value
+        config = Config.readIni(allowNoValue=True)
+        # the values are already interpolated
+        config.read_dict(
+            {
+                section: {
+                    k: v.replace("$", "$$") if v is not None else None
+                    for k, v in values.items()
+                }
+                for section, values in job["config"].items()
+            }
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            configFile = Path(tmp) / "config.ini"
+            Config.writeIni(config, configFile)
+            master = self.createMaster(
+                [configFile],
+                job.get("commands"),
+                None,
+                job["targets"],
+                outputHandler=output,
+                prepare=False,
+            )
+            workDir = master.config.get("Variables", "Root")
+            with self._lock:
+                setupLock = self._setupLocks.setdefault(workDir, threading.Lock())
+            # jobs of other coordinators and other agents on this host might set up
+            # craft-clone in the same work dir
+            with setupLock, fileLock(os.path.join(workDir, ".craftmaster-setup.lock")):
+                master.prepare()
+            return master.run()
+
+
+def parseAddress(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def dispatch(agents, job, targets, output, key=None):
+    """Build targets on the agents, each agent pulls the next target when it is idle.
+
+    A target whose agent dies is rescheduled on the remaining agents, an agent
+    refusing key is not used.
+    Returns a dict of target to a dict with the exit code, the duration and the agent.
+    """
+    pending = queue.Queue()
+    for target in targets:
+        pending.put(target)
+    results = {}
+    alive = list(agents)
+
+    def work(agent):
+        try:
+            with socket.create_connection(parseAddress(agent)) as connection:
+                with connection.makefile("rwb") as stream:
+                    _answerChallenge(stream, key)
+                    while True:
+                        try:
+                            target = pending.get_nowait()
+                        except queue.Empty:
+                            return
+                        try:
+                            sendMessage(stream, dict(job, targets=[target]))
+                            for message in readMessages(stream):
+                                if message["type"] == "output":
+                                    output(target, message["line"])
+                                elif message["type"] == "exit":
+                                    results[target] = {
+                                        "exitCode": message["code"],
+                                        "duration": message["duration"],
+                                        "agent": agent,
+                                    }
+                                    break
+                            else:
+                                raise ConnectionError("connection closed")
+                        except (OSError, ValueError):
+                            pending.put(target)
+                            raise
+        except (OSError, ValueError) as e:
+            output(None, f"Agent {agent} failed: {e}")
+            alive.remove(agent)
+
+    while not pending.empty() and alive:
+        threads = [threading.Thread(target=work, args=(agent,)) for agent in alive]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    while not pending.empty():
+        target = pending.get()
+        output(target, "No agent left to build the target")
+        results[target] = {"exitCode": 1, "duration": 0, "agent": None}
+    return results
@@ -4,10 +4,48 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import configparser
+import hashlib
+import json
 import os
 import platform
+import re
 from pathlib import Path
 
+from Errors import ConfigError
+
+# ${Env:NAME}
+_ENV_REFERENCE = re.compile(r"\$\{Env:([^}]+)\}")
+
+
+class _Parser(configparser.ConfigParser):
+    """A ConfigParser that reports changes of its values to onChange."""
+
+    onChange = None
+
+    def set(self, section, option, value=None):
+        super().set(section, option, value)
+        if self.onChange:
+            self.onChange()
+
+    def remove_option(self, section, option):
+        removed = super().remove_option(section, option)
+        if self.onChange:
+            self.onChange()
+        return removed
+
+    def remove_section(self, section):
+        removed = super().remove_section(section)
+        if self.onChange:
+            self.onChange()
+        return removed
+
+    def rawSections(self):
+        """Each section with its raw values including the defaults, like items."""
+        sections = {self.default_section: dict(self._defaults)}
+        for section, values in self._sections.items():
+            sections[section] = {**self._defaults, **values}
+        return sections
+
 
 class Config(object):
     ReservedSections = {
@@ -17,6 +55,9 @@ class Config(object):
         "BlueprintSettings",
         "Env",
     }
+    Platforms = ["windows", "macos", "linux", "android"]
+    # ${key} or ${Section:key}, like configparser.ExtendedInterpolation
+    _REFERENCE = re.compile(r"\$\{([^}]+)\}")
 
     @staticmethod
     def isWin():
@@ -51,28 +92,77 @@ class Config(object):
         elif Config.isAndroid():
             return "android"
 
-    def __init__(self, configFiles: [Path], variables):
+    def __init__(
+        self, configFiles: [Path], variables, snapshotDir=None, log=None, environ=None
+    ):
+        # receives warnings, like a snapshot that can not be written
+        self._log = log
+        # fills [Env], a job of the server uses the environment of its client
+        self._environ = os.environ if environ is None else environ
         self._targets = None
-        self._config = configparser.ConfigParser(
+        # section to key to interpolated value, None while it needs to be resolved
+        self._resolved = None
+        # (section, key) to the reason it can not be interpolated
+        self._unresolved = {}
+        self._config = _Parser(
             interpolation=configparser.ExtendedInterpolation(), allow_no_value=True
         )
         self._config.optionxform = str
+        self._config.onChange = self._invalidate
         for configFile in configFiles:
             if not configFile.is_file():
-                print(f"Config file {configFile} does not exist.")
-                exit(1)
+                raise ConfigError(f"Config file {configFile} does not exist.")
+
+        snapshot = None
+        if snapshotDir:
+            snapshotKey = self._snapshotKey(configFiles, variables)
+            snapshotFile = Path(snapshotDir) / (
+                "config-"
+                + hashlib.sha256(
+                    "\n".join(str(x) for x in configFiles).encode("utf-8")
+                ).hexdigest()
+                + ".json"
+            )
+            snapshot = self._loadSnapshot(snapshotFile, snapshotKey)
+        if snapshot:
+            self._config.read_dict(snapshot["sections"])
+        else:
+            self._read(configFiles, variables)
+
+        if "Env" not in self._config.sections():
+            self._config.add_section("Env")
+        self._config["Env"].update(
+            filter(lambda i: "$" not in i[0] and "$" not in i[1], self._environ.items())
+        )
+
+        self._resolve(snapshot["resolved"] if snapshot else None)
+        if snapshotDir and not snapshot:
+            self._saveSnapshot(snapshotFile, snapshotKey)
+
+        if self.get("General", "DumpConfig", default=False):
+            with open(f"{configFiles[0]}.dump", "wt+", encoding="UTF-8") as dump:
+                for section, value in self._config.items():
+                    dump.write(f"[{section}]\n")
+                    dump.writelines(
+                        [f"{k} = {v}\n" for k, v in value.items()] + ["\n\n"]
+                    )
+
+    def _read(self, configFiles: [Path], variables):
+        for configFile in configFiles:
             self._config.read(configFile, encoding="utf-8")
         if "Variables" not in self._config.sections():
             self._config.add_section("Variables")
         if variables:
             for var in variables:
                 if "=" not in var:
-                    print(f"Invalid variable: {var}")
-                    exit(1)
+                    raise ConfigError(f"Invalid variable: {var}")
                 key, value = var.split("=", 1)
                 self._config.set("Variables", key, value)
+        # resolving the whole config is pointless before it is complete
         self._config.set(
-            "Variables", "Root", self.get("Variables", "Root", self.defaultWorkDir)
+            "Variables",
+            "Root",
+            self._config.get("Variables", "Root", fallback=self.defaultWorkDir),
         )
         self._config.set("Variables", "CraftMasterRoot", os.path.dirname(__file__))
         self._config.set(
@@ -80,19 +170,200 @@ class Config(object):
             "CraftMasterConfigFolder",
             configFiles[0].parent.resolve().as_posix(),
         )
-        if "Env" not in self._config.sections():
-            self._config.add_section("Env")
-        self._config["Env"].update(
-            filter(lambda i: "$" not in i[0] and "$" not in i[1], os.environ.items())
-        )
 
-        if self.get("General", "DumpConfig", default=False):
-            with open(f"{configFiles[0]}.dump", "wt+", encoding="UTF-8") as dump:
-                for section, value in self._config.items():
-                    dump.write(f"[{section}]\n")
-                    dump.writelines(
-                        [f"{k} = {v}\n" for k, v in value.items()] + ["\n\n"]
-                    )
+    @staticmethod
+    def referencedEnvironment(configFiles: [Path]):
+        """The names of the environment variables the config files refer to."""
+        environment = set()
+        for configFile in configFiles:
+            environment.update(
+                _ENV_REFERENCE.findall(
+                    Path(configFile).read_text(encoding="utf-8", errors="replace")
+                )
+            )
+        return sorted(environment)
+
+    def _snapshotKey(self, configFiles: [Path], variables):
+        """Hash everything the parsed and interpolated config depends on."""
+        files = []
+        environment = set()
+        for configFile in configFiles:
+            data = configFile.read_bytes()
+            stat = configFile.stat()
+            files.append(
+                [
+                    str(configFile.resolve()),
+                    stat.st_mtime_ns,
+                    hashlib.sha256(data).hexdigest(),
+                ]
+            )
+            environment.update(_ENV_REFERENCE.findall(data.decode("utf-8", "replace")))
+        return hashlib.sha256(
+            json.dumps(
+                {
+                    "files": files,
+                    "variables": variables or [],
+                    "root": os.path.dirname(os.path.abspath(__file__)),
+                    "platform": Config.platformPrefix(),
+                    "env": {k: self._environ.get(k) for k in sorted(environment)},
+                },
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def _loadSnapshot(self, snapshotFile: Path, key):
+        try:
+            with open(snapshotFile, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot["key"] == key:
+                return snapshot
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _saveSnapshot(self, snapshotFile: Path, key):
+        """Store the raw config and all values that could be resolved."""
+        sections = {}
+        for section in self._config.sections():
+            sections[section] = dict(self._config.items(section, raw=True))
+        # the environment is added again on load
+        sections["Env"] = {
+            k: v for k, v in sections["Env"].items() if self._environ.get(k) != v
+        }
+        resolved = self.resolvedSections()
+        try:
+            snapshotFile.parent.mkdir(parents=True, exist_ok=True)
+            tmp = snapshotFile.with_name(f"{snapshotFile.name}.{os.getpid()}.tmp")
+            with open(tmp, "wt", encoding="utf-8") as f:
+                json.dump({"key": key, "sections": sections, "resolved": resolved}, f)
+            os.replace(tmp, snapshotFile)
+        except OSError as e:
+            if self._log:
+                self._log(f"Failed to write the config snapshot {snapshotFile}: {e}")
+
+    def _invalidate(self):
+        self._resolved = None
+
+    @staticmethod
+    def _parseValue(value):
+        """Split a raw value into strings and (section, key) references.
+
+        The section of a reference to the own section is None.
+        """
+        parts = []
+        rest = value
+        while rest:
+            index = rest.find("$")
+            if index < 0:
+                parts.append(rest)
+                break
+            if index > 0:
+                parts.append(rest[:index])
+            rest = rest[index:]
+            if rest[1:2] == "$":
+                parts.append("$")
+                rest = rest[2:]
+            elif rest[1:2] == "{":
+                match = Config._REFERENCE.match(rest)
+                if not match:
+                    raise ValueError(f"unterminated reference in '{value}'")
+                path = match.group(1).split(":")
+                if len(path) > 2:
+                    raise ValueError(f"more than one ':' in {match.group(0)}")
+                parts.append(tuple(path) if len(path) == 2 else (None, path[0]))
+                rest = rest[match.end() :]
+            else:
+                raise ValueError(f"'$' must be followed by '$' or '{{' in '{value}'")
+        return parts
+
+    def _resolve(self, seed=None):
+        """Interpolate all values at once, each value is only resolved once.
+
+        A value is resolved after the values it references, values that can not
+        be resolved are recorded in _unresolved with the reason.
+        seed holds values that are already known to be resolved.
+        """
+        raw = self._config.rawSections()
+        resolved = {}
+        pending = []
+        for section, values in raw.items():
+            resolved[section] = {}
+            for key, value in values.items():
+                if value is None or "$" not in value:
+                    resolved[section][key] = value
+                else:
+                    pending.append((section, key))
+        for section, values in (seed or {}).items():
+            if section in raw:
+                resolved[section].update(
+                    (k, v) for k, v in values.items() if k in raw[section]
+                )
+        unresolved = {}
+        stack = []
+        visiting = set()
+
+        def name(node):
+            return f"[{node[0]}] {node[1]}"
+
+        def resolve(node):
+            section, key = node
+            if key in resolved[section]:
+                return True
+            if node in unresolved:
+                return False
+            if node in visiting:
+                cycle = stack[stack.index(node) :] + [node]
+                text = " -> ".join(name(x) for x in cycle)
+                for x in cycle[:-1]:
+                    unresolved[x] = f"{name(x)}: cyclic reference {text}"
+                return False
+            try:
+                parts = Config._parseValue(raw[section][key])
+            except ValueError as e:
+                unresolved[node] = f"{name(node)}: {e}"
+                return False
+            stack.append(node)
+            visiting.add(node)
+            try:
+                result = []
+                for part in parts:
+                    if isinstance(part, str):
+                        result.append(part)
+                        continue
+                    reference = (part[0] or section, part[1])
+                    if reference[1] not in raw.get(reference[0], {}):
+                        unresolved.setdefault(
+                            node,
+                            f"{name(node)}: ${{{':'.join(reference)}}} does not exist",
+                        )
+                        return False
+                    if not resolve(reference):
+                        unresolved.setdefault(
+                            node,
+                            f"{name(node)}: depends on {name(reference)}, which can "
+                            "not be resolved",
+                        )
+                        return False
+                    if resolved[reference[0]][reference[1]] is None:
+                        unresolved[node] = f"{name(node)}: {name(reference)} is empty"
+                        return False
+                    result.append(resolved[reference[0]][reference[1]])
+            finally:
+                stack.pop()
+                visiting.discard(node)
+            resolved[section][key] = "".join(result)
+            return True
+
+        for node in pending:
+            resolve(node)
+        self._resolved = resolved
+        self._unresolved = unresolved
+
+    def unresolved(self):
+        """The reasons of all values that can not be interpolated."""
+        if self._resolved is None:
+            self._resolve()
+        return list(self._unresolved.values())
 
     def __contains__(self, key):
         if isinstance(key, tuple):
@@ -104,37 +375,80 @@ class Config(object):
     def defaultWorkDir(self):
         return os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
+    def _filterTargets(self, platformPrefixes):
+        def _filter(x):
+            if not x.startswith(platformPrefixes):
+                return False
+            abi, key = x.rsplit("-", 1)
+            if key in {"BlueprintSettings", "Settings"}:
+                if abi not in targets:
+                    raise ConfigError(f"Unable to find {abi} in targets")
+                return False
+            return True
+
+        targets = set(self._config.sections())
+        targets -= Config.ReservedSections
+        return list(filter(_filter, targets))
+
     @property
     def targets(self):
         if not self._targets:
-            platformPrefix = Config.platformPrefix()
-
-            def _filter(x):
-                if not x.startswith(platformPrefix):
-                    return False
-                abi, key = x.rsplit("-", 1)
-                if key in {"BlueprintSettings", "Settings"}:
-                    if abi not in targets:
-                        print(f"Unable to find {abi} in targets")
-                        exit(1)
-                    return False
-                return True
-
-            targets = set(self._config.sections())
-            targets -= Config.ReservedSections
-            self._targets = list(filter(_filter, targets))
+            self._targets = self._filterTargets(Config.platformPrefix())
         return self._targets
 
+    def allTargets(self):
+        """The targets of all platforms, targets only lists the current platform."""
+        return self._filterTargets(tuple(Config.Platforms))
+
+    def resolvedSections(self):
+        """All sections but Env with their interpolated values.
+
+        Values that can not be interpolated are left out.
+        """
+        if self._resolved is None:
+            self._resolve()
+        sections = {}
+        for section in self._config.sections():
+            if section == "Env":
+                continue
+            sections[section] = {
+                key: self._resolved[section][key]
+                for key in self._config[section]
+                if key in self._resolved[section]
+            }
+        return sections
+
+    def rootDir(self, target):
+        """The absolute path of the Craft root of target."""
+        return os.path.abspath(
+            os.path.join(
+                self.get("Variables", "Root"),
+                self.get("Settings", "Root", target, target=target),
+            )
+        )
+
     def getSection(self, section):
-        return self._config[section].items()
+        return [(key, self._get(section, key)) for key in self._config[section]]
+
+    def _get(self, section, key):
+        if self._resolved is None:
+            self._resolve()
+        if (section, key) in self._unresolved:
+            raise ConfigError(
+                f"Failed to interpolate {self._unresolved[(section, key)]}"
+            )
+        if key in self._resolved.get(section, {}):
+            return self._resolved[section][key]
+        # raises the error for a missing section or key
+        return self._config.get(section, key)
 
     def get(self, section, key, default=configparser._UNSET, target=None):
         targetSection = f"{target}-{section}"
         if (targetSection, key) in self:
-            return self._config.get(targetSection, key)
+            return self._get(targetSection, key)
         if default != configparser._UNSET and (section, key) not in self:
             return default
-        return self._config.get(section, key)
+        return self._get(section, key)
 
     def getBool(self, section, key, default=False, target=None):
         return self._config._convert_to_boolean(
@@ -142,13 +456,32 @@ class Config(object):
         )
 
     @staticmethod
-    def readIni(path=None):
-        parser = configparser.ConfigParser(interpolation=None)
+    def parseSize(value):
+        """Parse a size like 512M or 8G to bytes, a plain number is in bytes."""
+        units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+        value = value.strip().upper().removesuffix("B")
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+
+    @staticmethod
+    def readIni(path=None, allowNoValue=False):
+        parser = configparser.ConfigParser(
+            interpolation=None, allow_no_value=allowNoValue
+        )
         parser.optionxform = str
         if path:
             parser.read(path, encoding="utf-8")
         return parser
 
+    @staticmethod
+    def copyIni(config):
+        """Copy an ini returned by readIni, a lot faster than copy.deepcopy."""
+        clone = Config.readIni()
+        clone.read_dict({config.default_section: config.defaults()})
+        clone.read_dict({x: config._sections[x] for x in config.sections()})
+        return clone
+
     @staticmethod
     def writeIni(config, path):
         with open(path, "wt", encoding="utf-8") as configfile:
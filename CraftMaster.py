@@ -4,20 +4,51 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import argparse
+import configparser
+import contextlib
 import errno
+import hashlib
 import json
 import os
 import re
 import shutil
+import signal
 import stat
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from Config import Config
+from CraftWorker import CraftWorker
+from DownloadStore import DownloadStore
+from Errors import CommandError, ConfigError, CraftMasterError
+from FileLock import fileLock
+from GarbageCollector import GarbageCollector
+from MemoStore import MemoStore
+from ProcessGroup import groupArgs, killGroup
+from ResourceLog import (
+    ResourceLog,
+    compareResourceLogs,
+    targetDurations,
+    usageFromRusage,
+)
+from RootTemplate import cloneTree
+from Scheduler import ResourceScheduler, shardTargets
+from TargetLog import TargetLog
+from Trace import Trace
 
 
 class CraftMaster(object):
+    # serialises output of targets running in parallel
+    _logLock = threading.Lock()
+    # the file lock of a Craft mirror does not exclude threads on all platforms
+    _mirrorLock = threading.Lock()
+    # receives all output instead of stdout and stderr, used by the job server
+    outputHandler = None
+
     def __init__(
         self,
         configFiles: [str],
@@ -26,12 +57,65 @@ class CraftMaster(object):
         targets,
         setup: bool = False,
         verbose=False,
+        jobs=None,
+        persistentWorker=None,
+        configCache=None,
+        trace=None,
+        logDir=None,
+        compressLogs=None,
+        resume=False,
+        outputHandler=None,
+        prepare=True,
+        memo=None,
+        resourceLog=None,
+        failFast=None,
+        commandTimeout=None,
+        targetTimeout=None,
+        shard=None,
+        shardHistory=None,
+        environ=None,
     ):
         self.commands = [commands] if commands else []
         self.targets = set(targets) if targets else set()
         self.verbose = verbose
         self.doSetup = setup
-        self._setConfig([Path(x).absolute() for x in configFiles], variables)
+        self.jobs = jobs
+        self.persistentWorker = persistentWorker
+        self.trace = trace or Trace()
+        self.logDir = logDir
+        self.compressLogs = compressLogs
+        self.resume = resume
+        self.outputHandler = outputHandler
+        self.memo = memo
+        self.failFast = failFast
+        self.commandTimeout = commandTimeout
+        self.targetTimeout = targetTimeout
+        # the 1 based index and the number of shards
+        self.shard = shard
+        self.shardHistory = shardHistory
+        self.shards = None
+        # the environment of the commands, a job of the server uses the one of
+        # its client
+        self.environ = os.environ if environ is None else environ
+        self.craftRevision = ""
+        self.craftRoots = {}
+        # the settings and template digests shared by all targets, built once
+        # per prepare
+        self._baseSettings = {}
+        # target to a dict with its status, exit code, duration and log file
+        self.results = {}
+        self._cancelled = threading.Event()
+        self._running = set()
+        self._runningLock = threading.Lock()
+        self._setConfig(
+            [Path(x).absolute() for x in configFiles], variables, configCache, prepare
+        )
+        resourceLog = resourceLog or self.config.get("General", "ResourceLog", None)
+        self.resourceLog = None
+        if resourceLog:
+            self.resourceLog = ResourceLog(
+                os.path.join(self.config.get("Variables", "Root"), resourceLog)
+            )
 
     # https://stackoverflow.com/a/1214935
     @staticmethod
@@ -43,24 +127,154 @@ class CraftMaster(object):
         else:
             raise Exception()
 
-    def _log(self, text, stream=sys.stdout):
-        print(text, file=stream)
+    def _log(self, text, stream=None):
+        if self.outputHandler:
+            self.outputHandler(text)
+            return
+        with CraftMaster._logLock:
+            print(text, file=stream or sys.stdout, flush=True)
 
-    def _error(self, text, fatal=True):
-        self._log(text, stream=sys.stderr)
+    def _error(self, text, fatal=True, error=CraftMasterError):
+        """Raise error, or only log text if the error is not fatal."""
         if fatal:
-            exit(1)
+            raise error(text)
+        self._log(text, stream=sys.stderr)
 
     def _debug(self, text):
         if self.verbose:
             self._log(text)
 
-    def _run(self, args, **kwargs):
+    def _run(
+        self,
+        args,
+        fatal=True,
+        output=None,
+        cpus=None,
+        usage=None,
+        timeout=None,
+        killable=False,
+        **kwargs,
+    ):
+        """Run args and return the exit code.
+
+        A killable command runs in its own process group, which is killed after
+        timeout seconds or when the run is cancelled. usage is filled with the
+        resources the command used and whether it timed out.
+        """
         command = " ".join(args)
         self._debug(command)
-        out = subprocess.run(args, stderr=subprocess.STDOUT, **kwargs)
-        if not out.returncode == 0:
-            self._error(f"Command {command} failed with exit code: {out.returncode}")
+        if usage is None:
+            usage = {}
+        if killable:
+            kwargs.update(groupArgs())
+        start = time.monotonic()
+        with subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE if output else None,
+            stderr=subprocess.STDOUT,
+            **kwargs,
+        ) as process:
+
+            def kill(timedOut=False):
+                usage["timedOut"] = timedOut
+                killGroup(process)
+
+            timer = None
+            if killable:
+                self._track(kill)
+                if timeout is not None:
+                    timer = threading.Timer(timeout, kill, kwargs={"timedOut": True})
+                    timer.daemon = True
+                    timer.start()
+            try:
+                if cpus:
+                    # inherited by everything craft starts later on
+                    os.sched_setaffinity(process.pid, cpus)
+                if output:
+                    # bound the length of a line, craft might print progress
+                    # without newlines
+                    for line in iter(lambda: process.stdout.readline(64 * 1024), b""):
+                        output(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+                if hasattr(os, "wait4"):
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    process.returncode = os.waitstatus_to_exitcode(status)
+                    usage.update(usageFromRusage(rusage))
+            except BaseException:
+                # the process group does not get the signals of the terminal
+                if killable:
+                    killGroup(process)
+                raise
+            finally:
+                if timer:
+                    timer.cancel()
+                if killable:
+                    self._untrack(kill)
+        usage["wall"] = time.monotonic() - start
+        returncode = process.returncode
+        if returncode != 0:
+            self._commandFailed(command, returncode, usage, timeout, fatal)
+        return returncode
+
+    def _commandFailed(self, command, returncode, usage, timeout, fatal):
+        if usage.get("timedOut"):
+            message = f"Command {command} timed out after {timeout} seconds"
+        else:
+            message = f"Command {command} failed with exit code: {returncode}"
+        if fatal:
+            raise CommandError(command, returncode, message)
+        self._log(message, stream=sys.stderr)
+
+    def _track(self, kill):
+        """Register kill to be called when the run is cancelled."""
+        with self._runningLock:
+            self._running.add(kill)
+            cancelled = self._cancelled.is_set()
+        if cancelled:
+            kill()
+
+    def _untrack(self, kill):
+        with self._runningLock:
+            self._running.discard(kill)
+
+    def _cancel(self):
+        """Kill all running commands and let the queued targets skip their commands."""
+        with self._runningLock:
+            self._cancelled.set()
+            running = list(self._running)
+        for kill in running:
+            kill()
+
+    @contextlib.contextmanager
+    def _cancelOnSignals(self):
+        """Cancel the run on SIGINT and SIGTERM before they end CraftMaster.
+
+        The commands run in process groups of their own, so they do not get the
+        signals of the terminal or of a CI runner cancelling the job.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            # only the main thread can handle signals
+            yield
+            return
+        previous = {}
+
+        def handler(signum, frame):
+            self._cancel()
+            if not callable(previous[signum]):
+                # SIG_DFL would end the process
+                raise SystemExit(128 + signum)
+            # the host decides whether the signal ends it
+            previous[signum](signum, frame)
+
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            current = signal.getsignal(signum)
+            if current != signal.SIG_IGN:
+                previous[signum] = current
+                signal.signal(signum, handler)
+        try:
+            yield
+        finally:
+            for signum, current in previous.items():
+                signal.signal(signum, current or signal.SIG_DFL)
 
     @staticmethod
     def _extractPackageFromTitle(title):
@@ -162,6 +376,40 @@ class CraftMaster(object):
             stream=sys.stderr,
         )
 
+    @staticmethod
+    def _packageForPath(repository, path):
+        """Return the package whose blueprint directory contains path.
+
+        A directory name containing name.py is the blueprint of the package name.
+        """
+        directory = (Path(repository) / path).parent
+        while directory != Path(repository) and directory != directory.parent:
+            if (directory / f"{directory.name}.py").is_file():
+                return directory.name
+            directory = directory.parent
+        return None
+
+    def _changedPackages(self, repository, baseRef):
+        """Return the packages whose blueprints changed between baseRef and HEAD."""
+        try:
+            changed = subprocess.run(
+                ["git", "diff", "--name-only", "-z", f"{baseRef}...HEAD"],
+                cwd=repository,
+                check=True,
+                stdout=subprocess.PIPE,
+                encoding="utf-8",
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            self._error(f"Failed to list the files changed since {baseRef}: {e}")
+        packages = {
+            self._packageForPath(repository, path)
+            for path in changed.split("\0")
+            if path
+        }
+        packages.discard(None)
+        self._debug(f"Packages changed since {baseRef}: {sorted(packages)}")
+        return sorted(packages)
+
     def _init(self, workDir):
         craftClone = os.path.join(workDir, "craft-clone")
         branch = self.config.get("General", "Branch", "master")
@@ -170,29 +418,134 @@ class CraftMaster(object):
         craftUrl = self.config.get(
             "General", "CraftUrl", "https://invent.kde.org/packaging/craft.git"
         )
+        revision = self.config.get("General", "CraftRevision", None)
+        mirror = self.config.get("General", "CraftMirror", None)
+        isWorktree = os.path.isfile(os.path.join(craftClone, ".git"))
+        if mirror and (isWorktree or not os.path.exists(craftClone) or forceClone):
+            self._initWorktree(
+                os.path.join(workDir, mirror),
+                craftUrl,
+                craftClone,
+                revision or branch,
+                forceClone,
+            )
+            return
+
+        if forceClone and os.path.exists(craftClone):
+            shutil.rmtree(craftClone, onerror=CraftMaster.__handleRemoveReadonly)
+
+        if revision and self.config.getBool("General", "FetchRevisionOnly", False):
+            self._fetchRevision(craftUrl, craftClone, revision)
+            return
+
         args = []
         if shallowClone:
             args += ["--depth=1", "--no-single-branch"]
-        if forceClone and os.path.exists(craftClone):
-            shutil.rmtree(craftClone, onerror=CraftMaster.__handleRemoveReadonly)
 
         if not os.path.exists(craftClone):
             self._run(
                 ["git", "clone", "--branch", branch] + args + [craftUrl, craftClone]
             )
 
-        revision = self.config.get("General", "CraftRevision", None)
         if revision:
             self._run(["git", "-C", craftClone, "checkout", "-f", revision])
 
+    def _fetchRevision(self, craftUrl, craftClone, revision):
+        """Fetch only the pinned revision, with a full fetch as fallback."""
+        if not os.path.exists(os.path.join(craftClone, ".git")):
+            self._run(["git", "init", "--quiet", craftClone])
+            self._run(["git", "-C", craftClone, "remote", "add", "origin", craftUrl])
+        else:
+            self._run(
+                ["git", "-C", craftClone, "remote", "set-url", "origin", craftUrl]
+            )
+
+        sparseCheckout = self.config.get("General", "SparseCheckout", None)
+        if sparseCheckout:
+            self._run(
+                ["git", "-C", craftClone, "sparse-checkout", "set"]
+                + [x.strip() for x in sparseCheckout.split(";") if x.strip()]
+            )
+
+        known = subprocess.run(
+            ["git", "-C", craftClone, "cat-file", "-e", f"{revision}^{{commit}}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if known.returncode == 0:
+            self._run(["git", "-C", craftClone, "checkout", "-f", revision])
+            return
+
+        if (
+            self._run(
+                ["git", "-C", craftClone, "fetch", "--depth=1", "origin", revision],
+                fatal=False,
+            )
+            == 0
+        ):
+            self._run(["git", "-C", craftClone, "checkout", "-f", "FETCH_HEAD"])
+            return
+
+        self._log(
+            f"Warning: Failed to fetch only {revision}, falling back to a full fetch",
+            stream=sys.stderr,
+        )
+        args = ["git", "-C", craftClone, "fetch", "origin"]
+        if os.path.exists(os.path.join(craftClone, ".git", "shallow")):
+            args.append("--unshallow")
+        self._run(args)
+        self._run(["git", "-C", craftClone, "checkout", "-f", revision])
+
+    def _initWorktree(self, mirror, craftUrl, craftClone, revision, forceClone):
+        """Check out craft as a worktree of a bare mirror shared between work dirs."""
+        # other work dirs, in this process or others, use the mirror as well
+        with CraftMaster._mirrorLock, fileLock(f"{mirror}.lock"):
+            if not os.path.exists(mirror):
+                # clone next to the mirror first, an interrupted clone must not
+                # look like a mirror
+                tmp = f"{mirror}.cloning"
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp, onerror=CraftMaster.__handleRemoveReadonly)
+                self._run(["git", "clone", "--mirror", craftUrl, tmp])
+                os.replace(tmp, mirror)
+            elif self._run(["git", "-C", mirror, "fetch", "--prune"], fatal=False):
+                self._log(
+                    f"Warning: Failed to update the Craft mirror {mirror}, using the existing state",
+                    stream=sys.stderr,
+                )
+
+            if os.path.isdir(os.path.join(craftClone, ".git")):
+                # a full clone of a previous run, ForceClone was set
+                shutil.rmtree(craftClone, onerror=CraftMaster.__handleRemoveReadonly)
+            if not os.path.exists(craftClone):
+                # forget worktrees whose work dir was deleted
+                self._run(["git", "-C", mirror, "worktree", "prune"])
+                self._run(
+                    [
+                        "git",
+                        "-C",
+                        mirror,
+                        "worktree",
+                        "add",
+                        "--force",
+                        "--detach",
+                        os.path.abspath(craftClone),
+                        revision,
+                    ]
+                )
+                return
+
+        if forceClone:
+            self._run(["git", "-C", craftClone, "reset", "--hard", "--quiet"])
+            self._run(["git", "-C", craftClone, "clean", "-fdx", "--quiet"])
+        self._run(["git", "-C", craftClone, "checkout", "-f", "--detach", revision])
+
     def _setRoots(self, workDir, craftRoots):
         self.craftRoots = {}
         for root in craftRoots:
-            craftRoot = os.path.abspath(
-                os.path.join(
-                    workDir, self.config.get("Settings", "Root", root, target=root)
-                )
-            )
+            craftRoot = self.config.rootDir(root)
+            if not os.path.exists(craftRoot):
+                self._provisionRoot(root, craftRoot)
             os.makedirs(os.path.join(craftRoot, "etc"), exist_ok=True)
             if not os.path.isfile(os.path.join(craftRoot, "craft", "craftenv.ps1")):
                 src = os.path.join(workDir, "craft-clone")
@@ -212,102 +565,287 @@ class CraftMaster(object):
                     os.symlink(src, dest, target_is_directory=True)
             self.craftRoots[root] = craftRoot
 
-    def _setConfig(self, configFiles: Path, variables):
-        self.config = Config(configFiles, variables)
+    def _templateRoot(self, root):
+        """The directory of General/TemplateRoot of root, a target or a directory."""
+        template = self.config.get("General", "TemplateRoot", None, target=root)
+        if not template:
+            return None
+        if template in self.config.allTargets():
+            return self.config.rootDir(template)
+        return os.path.abspath(
+            os.path.join(self.config.get("Variables", "Root"), template)
+        )
 
-        workDir = self.config.get("Variables", "Root")
+    def _provisionRoot(self, root, craftRoot):
+        """Clone a new root from General/TemplateRoot, a target or a directory."""
+        template = self._templateRoot(root)
+        if not template:
+            return
+        if not os.path.isdir(template):
+            self._log(
+                f"Warning: The template root {template} does not exist, "
+                f"setting up {root} from scratch",
+                stream=sys.stderr,
+            )
+            return
+        self._log(f"Provisioning {root} from {template}", stream=sys.stderr)
+        # clone next to the root first, an interrupted clone must not look like a root
+        tmp = f"{craftRoot}.provisioning"
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp, onerror=CraftMaster.__handleRemoveReadonly)
+        counts = cloneTree(
+            template,
+            tmp,
+            skip=[
+                # recreated for the new root
+                "craft",
+                "etc/CraftSettings.ini",
+                "etc/BlueprintSettings.ini",
+                "etc/craftmaster_fingerprint",
+                "etc/craftmaster_journal.json",
+                "etc/craftmaster_setup",
+            ],
+        )
+        os.replace(tmp, craftRoot)
+        self._debug(f"Provisioned {root}: {dict(counts)}")
+
+    def _setConfig(self, configFiles: Path, variables, configCache=None, prepare=True):
+        with self.trace.span("config", "phase"):
+            self.config = Config(
+                configFiles,
+                variables,
+                snapshotDir=configCache,
+                log=lambda line: self._log(line, stream=sys.stderr),
+                environ=self.environ,
+            )
 
         if self.targets:
             if not self.targets.issubset(self.config.targets):
-                for n in self.targets - set(self.config.targets):
-                    self._error(
-                        f"Target {n} is not a valid target. Valid targets are {self.config.targets}, for the Platform: {Config.platformPrefix()}",
-                        fatal=False,
+                raise ConfigError(
+                    "\n".join(
+                        f"Target {n} is not a valid target. Valid targets are {self.config.targets}, for the Platform: {Config.platformPrefix()}"
+                        for n in sorted(self.targets - set(self.config.targets))
                     )
-                exit(1)
+                )
         else:
             self.targets = self.config.targets
 
         if not self.targets:
-            self._error("Please specify at least one target category")
+            self._error(
+                "Please specify at least one target category", error=ConfigError
+            )
+        if self.shard:
+            self._setShard()
+            if not self.targets:
+                self._log(
+                    f"Shard {self.shard[0]}/{self.shard[1]} has no targets",
+                    stream=sys.stderr,
+                )
+                self.craftRoots = {}
+                return
+        if prepare:
+            self.prepare()
 
-        self._init(workDir)
-        self._setRoots(workDir, self.targets)
+    def prepare(self):
+        """Set up Craft, the roots of the targets and their settings."""
+        workDir = self.config.get("Variables", "Root")
+        with self.trace.span("init", "phase"):
+            self._init(workDir)
+        with self.trace.span("roots", "phase"):
+            self._setRoots(workDir, self.targets)
+        revision = self._craftRevision(os.path.join(workDir, "craft-clone"))
+        self.craftRevision = revision
 
-        for root in self.targets:
-            craftDir = self.craftRoots[root]
-            blueprintSetting = Config.readIni()
-            # TODO: use ini?
-            setupFile = Path(craftDir) / "etc/craftmaster_setup"
-            if not self.doSetup and setupFile.exists():
-                continue
-            if self.doSetup:
-                setupFile.touch()
-            self._log("Generate Settings", stream=sys.stderr)
+        self._baseSettings = {}
+        with self.trace.span("settings", "phase"):
+            for root in self.targets:
+                with self.trace.span("settings", "target", target=root):
+                    self._setTargetConfig(root, revision)
 
-            if "BlueprintSettings" in self.config:
-                self._setBluePrintSettings(
-                    self.config.getSection("BlueprintSettings"), config=blueprintSetting
+    def _setShard(self):
+        """Restrict the targets to the shard, balanced by the shard history."""
+        index, count = self.shard
+        durations = None
+        if self.shardHistory:
+            try:
+                durations = targetDurations(self.shardHistory)
+            except (OSError, ValueError, KeyError) as e:
+                self._log(
+                    f"Warning: Failed to read the shard history {self.shardHistory}: "
+                    f"{e}, splitting the targets by name",
+                    stream=sys.stderr,
                 )
+        self.shards = shardTargets(self.targets, count, durations)
+        self.targets = set(self.shards[index - 1])
 
-            if f"{root}-BlueprintSettings" in self.config:
-                self._setBluePrintSettings(
-                    self.config.getSection(f"{root}-BlueprintSettings"),
-                    config=blueprintSetting,
+    def _setTargetConfig(self, root, revision):
+        craftDir = self.craftRoots[root]
+        # TODO: use ini?
+        setupFile = Path(craftDir) / "etc/craftmaster_setup"
+        if not self.doSetup and setupFile.exists():
+            return
+        if self.doSetup:
+            setupFile.touch()
+
+        settingsFile = os.path.join(craftDir, "craft", "CraftSettings.ini.template")
+        if not os.path.exists(settingsFile):
+            self._error(f"{settingsFile} does not exist")
+        template = self._templateDigest(settingsFile)
+        fingerprintFile = Path(craftDir) / "etc/craftmaster_fingerprint"
+        fingerprint = self._settingsFingerprint(root, template, revision)
+        if (
+            fingerprintFile.exists()
+            and fingerprintFile.read_text(encoding="utf-8") == fingerprint
+            and (Path(craftDir) / "etc/CraftSettings.ini").exists()
+            and (Path(craftDir) / "etc/BlueprintSettings.ini").exists()
+        ):
+            self._debug(f"Settings of {root} are up to date")
+            return
+        self._log("Generate Settings", stream=sys.stderr)
+
+        blueprintSetting = self._sharedSettings(
+            ("blueprints",), self._baseBlueprintSettings
+        )
+        if f"{root}-BlueprintSettings" in self.config:
+            self._setBluePrintSettings(
+                self.config.getSection(f"{root}-BlueprintSettings"),
+                config=blueprintSetting,
+            )
+
+        Config.writeIni(
+            blueprintSetting, os.path.join(craftDir, "etc", "BlueprintSettings.ini")
+        )
+
+        try:
+            settings = self._sharedSettings(
+                ("settings", template), lambda: self._baseCraftSettings(settingsFile)
+            )
+            if f"{root}-GeneralSettings" in self.config:
+                # this doesn't make any sense?
+                self._log(
+                    f"Please replace the config: '{root}-GeneralSettings'  with '{root}' "
                 )
+                self._setSetting(
+                    self.config.getSection(f"{root}-GeneralSettings"),
+                    config=settings,
+                )
+
+            if root in self.config:
+                self._setSetting(self.config.getSection(root), config=settings)
+
+            if self._downloadStore():
+                # a directory per root, the store shares the downloads
+                self._setSetting(
+                    [("Paths/DownloadDir", self._downloadDir(craftDir))],
+                    config=settings,
+                )
+
+            cores = self._targetCores(root)
+            if cores and not settings.has_option("Compile", "Jobs"):
+                self._setSetting([("Compile/Jobs", str(cores))], config=settings)
 
             Config.writeIni(
-                blueprintSetting, os.path.join(craftDir, "etc", "BlueprintSettings.ini")
+                settings, os.path.join(craftDir, "etc", "CraftSettings.ini")
             )
 
-            settingsFile = os.path.join(craftDir, "craft", "CraftSettings.ini.template")
-            if not os.path.exists(settingsFile):
-                self._error(f"{settingsFile} does not exist")
-            try:
-                settings = Config.readIni(settingsFile)
-                # add ourself to the blueprints
-                settings.set(
-                    "Blueprints",
-                    "Locations",
-                    f"{os.path.dirname(os.path.abspath(__file__))}/blueprints;"
-                    + settings["Blueprints"].get("Locations", ""),
+            cache = os.path.join(craftDir, "etc", "cache.pickle")
+            if os.path.exists(cache):
+                os.remove(cache)
+            fingerprintFile.write_text(fingerprint, encoding="utf-8")
+        except CraftMasterError:
+            raise
+        except Exception as e:
+            with open(settingsFile, "rt") as f:
+                self._error(
+                    f"Failed to setup settings {settingsFile}\n{e}\n\nTemplate:\n{f.read()}"
                 )
 
-                if "GeneralSettings" in self.config:
-                    self._setSetting(
-                        self.config.getSection("GeneralSettings"), config=settings
-                    )
+    def _craftRevision(self, craftClone):
+        out = subprocess.run(
+            ["git", "-C", craftClone, "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf-8",
+        )
+        return out.stdout.strip() if out.returncode == 0 else ""
 
-                if f"{root}-GeneralSettings" in self.config:
-                    # this doesn't make any sense?
-                    self._log(
-                        f"Please replace the config: '{root}-GeneralSettings'  with '{root}' "
-                    )
-                    self._setSetting(
-                        self.config.getSection(f"{root}-GeneralSettings"),
-                        config=settings,
-                    )
+    def _sharedSettings(self, key, build):
+        """Return a copy of the settings shared by all targets, built once."""
+        if key not in self._baseSettings:
+            self._baseSettings[key] = build()
+        return Config.copyIni(self._baseSettings[key])
+
+    def _baseBlueprintSettings(self):
+        blueprintSetting = Config.readIni()
+        if "BlueprintSettings" in self.config:
+            self._setBluePrintSettings(
+                self.config.getSection("BlueprintSettings"), config=blueprintSetting
+            )
+        return blueprintSetting
 
-                if root in self.config:
-                    self._setSetting(self.config.getSection(root), config=settings)
+    def _baseCraftSettings(self, settingsFile):
+        settings = Config.readIni(settingsFile)
+        # add ourself to the blueprints
+        settings.set(
+            "Blueprints",
+            "Locations",
+            f"{os.path.dirname(os.path.abspath(__file__))}/blueprints;"
+            + settings["Blueprints"].get("Locations", ""),
+        )
 
-                Config.writeIni(
-                    settings, os.path.join(craftDir, "etc", "CraftSettings.ini")
-                )
+        if "GeneralSettings" in self.config:
+            self._setSetting(self.config.getSection("GeneralSettings"), config=settings)
+        return settings
 
-                cache = os.path.join(craftDir, "etc", "cache.pickle")
-                if os.path.exists(cache):
-                    os.remove(cache)
-            except Exception as e:
-                with open(settingsFile, "rt") as f:
-                    self._error(
-                        f"Failed to setup settings {settingsFile}\n{e}\n\nTemplate:\n{f.read()}"
-                    )
+    def _templateDigest(self, settingsFile):
+        """The sha256 of a settings template, most roots share the same file."""
+        path = os.path.realpath(settingsFile)
+        key = ("template", path)
+        if key not in self._baseSettings:
+            with open(path, "rb") as f:
+                self._baseSettings[key] = hashlib.sha256(f.read()).hexdigest()
+        return self._baseSettings[key]
+
+    def _settingsFingerprint(self, root, template, revision):
+        """Hash all inputs of the generated settings of root."""
+        sections = [
+            "Settings",
+            f"{root}-Settings",
+            "GeneralSettings",
+            "BlueprintSettings",
+            f"{root}-GeneralSettings",
+            f"{root}-BlueprintSettings",
+            root,
+        ]
+        inputs = {
+            "sections": {
+                section: list(self.config.getSection(section))
+                for section in sections
+                if section in self.config
+            },
+            "template": template,
+            "revision": revision,
+            "blueprints": os.path.dirname(os.path.abspath(__file__)),
+            "downloadStore": self.config.get("General", "DownloadStore", None),
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def _downloadStore(self):
+        store = self.config.get("General", "DownloadStore", None)
+        if not store:
+            return None
+        return DownloadStore(os.path.join(self.config.get("Variables", "Root"), store))
+
+    @staticmethod
+    def _downloadDir(craftDir):
+        return os.path.join(craftDir, "download")
 
     def _setSetting(self, settings, config):
         for key, value in settings:
             if "/" not in key:
-                self._error(f"Invalid option: {key} = {value}")
+                self._error(f"Invalid option: {key} = {value}", error=ConfigError)
             sectin, key = key.split("/", 1)
             if sectin not in config:
                 config.add_section(sectin)
@@ -316,47 +854,700 @@ class CraftMaster(object):
     def _setBluePrintSettings(self, settings, config):
         for key, value in settings:
             if "." not in key:
-                self._error(f"Invalid BlueprintSetting: {key} = {value}")
+                self._error(
+                    f"Invalid BlueprintSetting: {key} = {value}", error=ConfigError
+                )
             sectin, key = key.split(".", 1)
             if sectin not in config:
                 config.add_section(sectin)
             config[sectin][key] = value
 
-    def _exec(self, target, args):
+    def _exec(self, target, args, parallel=False, reservation=None):
         craftDir = self.craftRoots[target]
         try:
-            level = int(os.environ.get("CRAFT_VERBOSE", "0"))
+            level = int(self.environ.get("CRAFT_VERBOSE", "0"))
         except ValueError:
             level = 0
         level = max(0, min(level, 3))
         option_list = ["-" + "v" * level] if level > 0 else []
 
-        for command in args:
-            self._run(
-                [
-                    sys.executable,
-                    "-X",
-                    "utf8",
-                    "-u",
-                    os.path.join(craftDir, "craft", "bin", "craft.py"),
-                ]
-                + option_list
-                + command
+        craftPy = os.path.join(craftDir, "craft", "bin", "craft.py")
+        if self._cancelled.is_set():
+            self._log(f"Cancelling {target}", stream=sys.stderr)
+            self.results[target] = self._result("cancelled", None)
+            return 1
+        memo = self._memoStore()
+        memoKey = self._memoKey(target, args)
+        if memo and memoKey in memo:
+            self._log(
+                f"Skipping {target}, it is cached: its inputs are unchanged since its "
+                "last successful run",
+                stream=sys.stderr,
+            )
+            with self.trace.span(target, "target", target=target, cached=True):
+                pass
+            self.results[target] = self._result("cached", 0)
+            return 0
+        log = self._openLog(target)
+        if log:
+            output = log
+        elif parallel:
+            # prefix every line so the output of parallel targets stays readable
+            def output(line):
+                self._log(f"[{target}] {line}")
+
+        else:
+            output = self._log if self.outputHandler else None
+        journal = os.path.join(craftDir, "etc", "craftmaster_journal.json")
+        journalKey = self._journalKey(craftDir, args)
+        completed = self._readJournal(journal, journalKey) if self.resume else 0
+        self._writeJournal(journal, journalKey, completed)
+        env = self._commandEnvironment()
+        snapshot = self._environment(target)
+        if snapshot:
+            env = dict(env or self.environ)
+            env.update(snapshot)
+        # an unweighted target only counts with one core, its build tools keep
+        # their defaults
+        weighted = reservation and self._targetCores(target)
+        cpus = reservation.cpus if weighted else None
+        if weighted:
+            # let the build tools use the cores reserved for the target
+            env = dict(env or self.environ)
+            env["MAKEFLAGS"] = f"-j{reservation.cores}"
+            env["CMAKE_BUILD_PARALLEL_LEVEL"] = str(reservation.cores)
+        commandTimeout = self._timeout(self.commandTimeout, "CommandTimeout", target)
+        targetTimeout = self._timeout(self.targetTimeout, "TargetTimeout", target)
+        deadline = time.monotonic() + targetTimeout if targetTimeout else None
+        usage = {}
+        start = time.monotonic()
+        store = self._downloadStore()
+        if store:
+            linked = store.populate(self._downloadDir(craftDir))
+            self._debug(f"Linked {len(linked)} downloads into {target}")
+        with self.trace.span(target, "target", target=target) as targetSpan:
+            worker = self._startWorker(craftPy, output or self._log, env, cpus)
+            try:
+                returncode = 0
+                for index, command in enumerate(args):
+                    if index < completed:
+                        self._log(
+                            f"Skipping '{' '.join(command)}' on {target}, it already succeeded",
+                            stream=sys.stderr,
+                        )
+                        continue
+                    craftArgs = option_list + command
+                    if log:
+                        log(f"$ {' '.join(craftArgs)}")
+                    with self.trace.span(
+                        " ".join(command),
+                        "command",
+                        target=target,
+                        command=" ".join(craftArgs),
+                    ) as commandSpan:
+                        usage = {}
+                        timeout = commandTimeout
+                        if deadline is not None:
+                            remaining = max(deadline - time.monotonic(), 0)
+                            timeout = min(timeout or remaining, remaining)
+                        if worker and worker.alive:
+                            returncode = self._runInWorker(
+                                worker,
+                                craftPy,
+                                craftArgs,
+                                fatal=False,
+                                usage=usage,
+                                timeout=timeout,
+                            )
+                        else:
+                            returncode = self._run(
+                                [sys.executable, "-X", "utf8", "-u", craftPy]
+                                + craftArgs,
+                                fatal=False,
+                                output=output,
+                                cpus=cpus,
+                                usage=usage,
+                                timeout=timeout,
+                                killable=True,
+                                env=env,
+                            )
+                        commandSpan["exitCode"] = returncode
+                        commandSpan.update(usage)
+                    if self.resourceLog:
+                        self.resourceLog.record(
+                            dict(
+                                usage,
+                                target=target,
+                                command=" ".join(command),
+                                exitCode=returncode,
+                            )
+                        )
+                    if returncode != 0:
+                        break
+                    self._writeJournal(journal, journalKey, index + 1)
+                targetSpan["exitCode"] = returncode
+                if memo and returncode == 0:
+                    memo.add(memoKey, target)
+            except BaseException:
+                if worker:
+                    worker.kill()
+                raise
+            finally:
+                if worker:
+                    worker.close()
+                if log:
+                    log.close()
+                if store:
+                    added = store.collect(self._downloadDir(craftDir))
+                    self._debug(f"Stored {len(added)} downloads of {target}")
+        if returncode == 0:
+            status = "succeeded"
+        elif usage.get("timedOut"):
+            status = "timed out"
+        elif self._cancelled.is_set():
+            status = "cancelled"
+        else:
+            status = "failed"
+        self.results[target] = self._result(
+            status, returncode, time.monotonic() - start, log and log.path
+        )
+        if returncode != 0 and log:
+            self._log(
+                f"Last {len(log.tail)} lines of {target}, see {log.path}:\n"
+                + "\n".join(log.tail),
+                stream=sys.stderr,
+            )
+        return returncode
+
+    @staticmethod
+    def _result(status, exitCode, duration=0.0, log=None):
+        return {
+            "status": status,
+            "exitCode": exitCode,
+            "duration": duration,
+            "log": log,
+        }
+
+    def _timeout(self, value, key, target):
+        """Return the timeout in seconds from value or General/key, None without."""
+        if value is None:
+            value = self.config.get("General", key, None, target=target)
+        try:
+            value = float(value) if value else None
+        except ValueError:
+            self._error(f"Invalid General/{key}: {value}", error=ConfigError)
+        return value or None
+
+    def _environmentKey(self, craftDir):
+        """Identify the generated settings and the Craft revision of a root."""
+        fingerprintFile = Path(craftDir) / "etc/craftmaster_fingerprint"
+        fingerprint = ""
+        if fingerprintFile.exists():
+            fingerprint = fingerprintFile.read_text(encoding="utf-8")
+        return f"{fingerprint}-{self.craftRevision}"
+
+    def _commandEnvironment(self):
+        """The environment of the commands, None when it is the one of CraftMaster."""
+        return None if self.environ is os.environ else dict(self.environ)
+
+    def _captureEnvironment(self, target):
+        """Return the variables the Craft environment of target sets or changes."""
+        craftDir = self.craftRoots[target]
+        helper = os.path.join(craftDir, "craft", "bin", "CraftSetupHelper.py")
+        if not os.path.isfile(helper):
+            self._log(
+                f"Warning: {helper} does not exist, not using an environment snapshot",
+                stream=sys.stderr,
+            )
+            return None
+        out = subprocess.run(
+            [sys.executable, "-X", "utf8", helper, "--getenv"],
+            cwd=craftDir,
+            env=self._commandEnvironment(),
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+        )
+        if out.returncode != 0:
+            self._log(
+                f"Warning: Failed to capture the environment of {target}",
+                stream=sys.stderr,
+            )
+            return None
+        environment = {}
+        key = None
+        for line in out.stdout.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                environment[key] = value
+            elif key:
+                # a value spanning several lines
+                environment[key] += "\n" + line
+        return {k: v for k, v in environment.items() if self.environ.get(k) != v}
+
+    def _environment(self, target):
+        """Return the stored environment of target, capture it when it is outdated."""
+        if not self.config.getBool("General", "EnvironmentSnapshot", False):
+            return None
+        craftDir = self.craftRoots[target]
+        snapshotFile = os.path.join(craftDir, "etc", "craftmaster_environment.json")
+        key = self._environmentKey(craftDir)
+        try:
+            with open(snapshotFile, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot["key"] == key:
+                return snapshot["environment"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        environment = self._captureEnvironment(target)
+        if environment is not None:
+            with open(snapshotFile, "wt", encoding="utf-8") as f:
+                json.dump({"key": key, "environment": environment}, f, indent=1)
+        return environment
+
+    def verifyEnvironment(self):
+        """Compare the stored environments with freshly captured ones.
+
+        Returns 1 if an environment drifted from its snapshot.
+        """
+        if not self.config.getBool("General", "EnvironmentSnapshot", False):
+            self._error("Please enable General/EnvironmentSnapshot", error=ConfigError)
+        drifted = False
+        for target in sorted(self.craftRoots):
+            stored = self._environment(target)
+            current = self._captureEnvironment(target)
+            if stored is None or current is None:
+                continue
+            changes = [
+                f"{key}: {stored.get(key)!r} -> {current.get(key)!r}"
+                for key in sorted(stored.keys() | current.keys())
+                if stored.get(key) != current.get(key)
+            ]
+            if changes:
+                drifted = True
+                self._log(
+                    f"The environment of {target} drifted from its snapshot:\n\t"
+                    + "\n\t".join(changes),
+                    stream=sys.stderr,
+                )
+        return 1 if drifted else 0
+
+    @staticmethod
+    def _journalKey(craftDir, commands):
+        """Identify the command list and the generated settings of a root."""
+        key = hashlib.sha256(json.dumps(commands).encode("utf-8"))
+        for name in ["CraftSettings.ini", "BlueprintSettings.ini"]:
+            try:
+                with open(os.path.join(craftDir, "etc", name), "rb") as f:
+                    key.update(hashlib.sha256(f.read()).digest())
+            except FileNotFoundError:
+                key.update(b"-")
+        return key.hexdigest()
+
+    def _memoStore(self):
+        enabled = self.memo
+        if enabled is None:
+            # opt-in, the blueprint checkouts are not part of the key
+            enabled = self.config.getBool("General", "Memo", False)
+        if not enabled:
+            return None
+        try:
+            size = int(self.config.get("General", "MemoSize", "1000"))
+        except ValueError:
+            self._error(
+                f"Invalid General/MemoSize: {self.config.get('General', 'MemoSize')}",
+                error=ConfigError,
+            )
+        return MemoStore(
+            os.path.join(self.config.get("Variables", "Root"), "craftmaster_memo.json"),
+            maxEntries=size,
+        )
+
+    def _memoKey(self, target, commands):
+        """Identify all inputs of a run of commands on target."""
+        key = hashlib.sha256(
+            json.dumps(
+                [target, self.craftRevision, self.environ.get("CRAFT_PACKAGE")]
+            ).encode("utf-8")
+        )
+        key.update(self._journalKey(self.craftRoots[target], commands).encode("utf-8"))
+        return key.hexdigest()
+
+    @staticmethod
+    def _readJournal(journal, key):
+        """Return the number of commands that already succeeded."""
+        try:
+            with open(journal, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            if data["key"] == key:
+                return int(data["completed"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return 0
+
+    @staticmethod
+    def _writeJournal(journal, key, completed):
+        with open(journal, "wt", encoding="utf-8") as f:
+            json.dump({"key": key, "completed": completed}, f)
+
+    def _openLog(self, target):
+        logDir = self.logDir or self.config.get("General", "LogDir", None)
+        if not logDir:
+            return None
+        compress = self.compressLogs
+        if compress is None:
+            compress = self.config.getBool("General", "CompressLogs", False)
+        try:
+            tailLines = int(self.config.get("General", "LogTailLines", "50"))
+        except ValueError:
+            self._error(
+                f"Invalid General/LogTailLines: {self.config.get('General', 'LogTailLines')}",
+                error=ConfigError,
+            )
+        return TargetLog(
+            os.path.join(self.config.get("Variables", "Root"), logDir, f"{target}.log"),
+            compress=compress,
+            tailLines=tailLines,
+        )
+
+    def _startWorker(self, craftPy, output, env=None, cpus=None):
+        enabled = self.persistentWorker
+        if enabled is None:
+            enabled = self.config.getBool("General", "PersistentWorker", False)
+        if not enabled:
+            return None
+        try:
+            return CraftWorker(craftPy, output, env=env, cpus=cpus)
+        except OSError as e:
+            self._log(
+                f"Warning: {e}, falling back to one process per command",
+                stream=sys.stderr,
+            )
+            return None
+
+    def _runInWorker(self, worker, craftPy, args, fatal=True, usage=None, timeout=None):
+        command = " ".join([sys.executable, "-X", "utf8", "-u", craftPy] + args)
+        self._debug(command)
+        if usage is None:
+            usage = {}
+
+        def kill(timedOut=False):
+            usage["timedOut"] = timedOut
+            worker.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill, kwargs={"timedOut": True})
+            timer.daemon = True
+            timer.start()
+        self._track(kill)
+        # the worker outlives the command, only the time is known
+        start = time.monotonic()
+        try:
+            returncode = worker.run(args)
+        finally:
+            if timer:
+                timer.cancel()
+            self._untrack(kill)
+        usage["wall"] = time.monotonic() - start
+        if returncode != 0:
+            self._commandFailed(command, returncode, usage, timeout, fatal)
+        return returncode
+
+    def _configuredJobs(self):
+        jobs = self.jobs
+        if jobs is None:
+            try:
+                jobs = int(self.config.get("General", "Jobs", "1"))
+            except ValueError:
+                self._error(
+                    f"Invalid General/Jobs: {self.config.get('General', 'Jobs')}",
+                    error=ConfigError,
+                )
+        return jobs
+
+    def _jobCount(self):
+        jobs = self._configuredJobs()
+        # 0 runs as many targets as the resources allow
+        return jobs if jobs > 0 else len(self.targets)
+
+    def _size(self, section, key, target=None):
+        value = self.config.get(section, key, None, target=target)
+        if not value:
+            return None
+        try:
+            return Config.parseSize(value)
+        except ValueError:
+            self._error(f"Invalid {section}/{key}: {value}", error=ConfigError)
+
+    def _scheduler(self):
+        cores = self.config.get("General", "Cores", None)
+        try:
+            cores = int(cores) if cores else None
+        except ValueError:
+            self._error(f"Invalid General/Cores: {cores}", error=ConfigError)
+        return ResourceScheduler(
+            cores=cores,
+            memory=self._size("General", "Memory"),
+            affinity=self.config.getBool("General", "CpuAffinity", False),
+        )
+
+    def _targetCores(self, target):
+        cores = self.config.get("Settings", "Cores", None, target=target)
+        try:
+            return int(cores) if cores else 0
+        except ValueError:
+            self._error(
+                f"Invalid Settings/Cores of {target}: {cores}", error=ConfigError
             )
 
+    def _execScheduled(self, scheduler, target, commands, defaultCores=0):
+        with scheduler.reserve(
+            cores=self._targetCores(target) or defaultCores,
+            memory=self._size("Settings", "Memory", target=target) or 0,
+            exclusive=self.config.getBool("Settings", "Exclusive", target=target),
+        ) as reservation:
+            return self._exec(target, commands, parallel=True, reservation=reservation)
+
+    def _commands(self):
+        commands = self.commands
+        if not commands:
+            commands = self.config.get("General", "Command", None)
+            if commands:
+                commands = [c.strip().split(" ") for c in commands.split(";") if c]
+        return commands
+
+    def _failFast(self, sequential):
+        failFast = self.failFast
+        if failFast is None:
+            # a sequential run always stopped at the first failing target
+            failFast = self.config.getBool("General", "FailFast", sequential)
+        return failFast
+
     def run(self):
-        for target in sorted(self.craftRoots.keys()):
-            commands = self.commands
-            if not commands:
-                commands = self.config.get("General", "Command", None)
-                if commands:
-                    commands = [c.strip().split(" ") for c in commands.split(";") if c]
-                if not commands:
-                    return
+        commands = self._commands()
+        if not commands:
+            return
+        with self._cancelOnSignals():
+            return self._runTargets(commands)
+
+    def _resetCancel(self):
+        """Forget the cancellation of a previous run."""
+        with self._runningLock:
+            self._cancelled = threading.Event()
+            self._running = set()
+
+    def _runTargets(self, commands):
+        self.results = {}
+        self._resetCancel()
+        targets = sorted(self.craftRoots.keys())
+        if not targets:
+            return 0
+        jobs = min(self._jobCount(), len(targets))
+        failFast = self._failFast(jobs == 1)
+        if jobs == 1:
+            for target in targets:
+                if self._exec(target, commands) != 0 and failFast:
+                    self._cancel()
+            return self._summary(targets)
+
+        scheduler = self._scheduler()
+        # without a job count the cores bound the number of targets, a target
+        # without Settings/Cores occupies one
+        defaultCores = 1 if self._configuredJobs() <= 0 else 0
+
+        def execTarget(target):
+            returncode = self._execScheduled(scheduler, target, commands, defaultCores)
+            if returncode != 0 and failFast:
+                self._cancel()
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            try:
+                for future in [pool.submit(execTarget, target) for target in targets]:
+                    future.result()
+            except BaseException:
+                # the pool waits for the running targets before it shuts down
+                self._cancel()
+                raise
+        return self._summary(targets)
+
+    def runTarget(self, target, commands=None):
+        """Run commands, by default the configured ones, on a prepared target.
+
+        Returns the result of the target, a dict with its status, exit code,
+        duration in seconds and the path of its log file or None.
+        """
+        if target not in self.craftRoots:
+            raise ConfigError(f"Target {target} is not prepared")
+        commands = commands or self._commands()
+        if not commands:
+            raise ConfigError("Please specify at least one command")
+        self._resetCancel()
+        with self._cancelOnSignals():
             self._exec(target, commands)
+        return self.results[target]
 
+    def _summary(self, targets):
+        """Log the targets that did not succeed, return the exit code of the run."""
+        unsuccessful = False
+        for status in ["timed out", "failed", "cancelled"]:
+            for target in targets:
+                result = self.results.get(target)
+                if not result or result["status"] != status:
+                    continue
+                unsuccessful = True
+                if status == "failed":
+                    message = f"failed with exit code: {result['exitCode']}"
+                else:
+                    message = status
+                self._log(f"Target {target} {message}", stream=sys.stderr)
+        return 1 if unsuccessful else 0
 
-if __name__ == "__main__":
+    @staticmethod
+    def _craftPath(craftRoot, key, default):
+        """Return the path Category/Key from the generated settings of a root."""
+        settings = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation()
+        )
+        try:
+            settings.read(os.path.join(craftRoot, "etc", "CraftSettings.ini"), "utf-8")
+        except (configparser.Error, UnicodeDecodeError):
+            # not generated by us, use the defaults of Craft
+            return os.path.join(craftRoot, default)
+        if not settings.has_section("Variables"):
+            settings.add_section("Variables")
+        # set by Craft at runtime
+        for name, value in [
+            ("CraftRoot", craftRoot),
+            ("CraftDir", os.path.join(craftRoot, "craft")),
+        ]:
+            if not settings.has_option("Variables", name):
+                settings.set("Variables", name, value.replace("$", "$$"))
+        section, option = key.split("/", 1)
+        try:
+            value = settings.get(section, option, fallback=None)
+        except configparser.Error:
+            value = None
+        return os.path.join(craftRoot, value or default)
+
+    def collectGarbage(self, dryRun=False):
+        """Remove stale roots, caches and build directories above General/DiskQuota."""
+        quota = self.config.get("General", "DiskQuota", None)
+        if not quota:
+            self._error(
+                "Please set General/DiskQuota to collect garbage", error=ConfigError
+            )
+        try:
+            quota = Config.parseSize(quota)
+        except ValueError:
+            self._error(f"Invalid General/DiskQuota: {quota}", error=ConfigError)
+        # the roots of other platforms and the template roots are not stale
+        targets = self.config.allTargets()
+        roots = [self.config.rootDir(x) for x in targets]
+        templates = filter(None, [self._templateRoot(x) for x in targets])
+        cacheDirs = []
+        buildDirs = []
+        for root in roots:
+            if os.path.isdir(root):
+                cacheDirs.append(self._craftPath(root, "Packager/CacheDir", "cache"))
+                cacheDirs.append(self._craftPath(root, "Paths/DownloadDir", "download"))
+                buildDirs.append(self._craftPath(root, "Paths/BuildDir", "build"))
+        store = self._downloadStore()
+        if store:
+            cacheDirs.append(store.objects)
+        collector = GarbageCollector(
+            self.config.get("Variables", "Root"),
+            roots + list(templates),
+            quota,
+            cacheDirs=cacheDirs,
+            buildDirs=buildDirs,
+            log=lambda line: self._log(line, stream=sys.stderr),
+        )
+        return collector.collect(dryRun=dryRun)
+
+    def reportResourceRegressions(self, previous, threshold=0.25):
+        """Log the commands more expensive than in the resource log previous."""
+        if not self.resourceLog:
+            self._error("Comparing resources requires a resource log")
+        if not self.resourceLog.recorded:
+            self._log("No commands were recorded to compare", stream=sys.stderr)
+            return
+        regressions = compareResourceLogs(previous, self.resourceLog.path, threshold)
+        if not regressions:
+            self._log(
+                f"No resource regressions compared to {previous}", stream=sys.stderr
+            )
+            return
+        self._log(
+            f"Resource regressions compared to {previous}:\n" + "\n".join(regressions),
+            stream=sys.stderr,
+        )
+
+    def dispatch(self, agents=None):
+        """Build the targets on remote agents instead of locally, see Agent.dispatch."""
+        from Agent import KEY_VARIABLE, dispatch
+
+        if not agents:
+            agents = [
+                x.strip()
+                for x in self.config.get("General", "Agents", "").split(";")
+                if x.strip()
+            ]
+        if not agents:
+            self._error("Please specify at least one agent", error=ConfigError)
+        if not self._commands():
+            return
+        logs = {}
+
+        def output(target, line):
+            if target is None:
+                self._log(line, stream=sys.stderr)
+            elif logs.get(target):
+                logs[target](line)
+            else:
+                self._log(f"[{target}] {line}")
+
+        for target in self.targets:
+            logs[target] = self._openLog(target)
+        config = self.config.resolvedSections()
+        # the agents know the key already
+        key = config.get("General", {}).pop("AgentKey", None)
+        key = key or self.environ.get(KEY_VARIABLE)
+        try:
+            results = dispatch(
+                agents,
+                {
+                    "config": config,
+                    "commands": self.commands[0] if self.commands else None,
+                },
+                sorted(self.targets),
+                output,
+                key=key,
+            )
+        finally:
+            for log in logs.values():
+                if log:
+                    log.close()
+        for target, result in sorted(results.items()):
+            self._log(
+                f"Target {target} finished with exit code {result['exitCode']} "
+                f"in {result['duration']:.1f}s on {result['agent']}",
+                stream=sys.stderr,
+            )
+        return 1 if any(x["exitCode"] for x in results.values()) else 0
+
+
+def parseShard(value):
+    try:
+        index, count = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form I/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"{value} is not a shard between 1/N and N/N")
+    return index, count
+
+
+def main():
     print("CraftMaster Arguments:", subprocess.list2cmdline(sys.argv), file=sys.stderr)
     parser = argparse.ArgumentParser(prog="Craft Master")
     parser.add_argument("--version", action="version", version="%(prog)s 0.2.9")
@@ -373,6 +1564,20 @@ if __name__ == "__main__":
         action="store_true",
         help="Print the package name determined from CRAFT_PACKAGE or CI titles.",
     )
+    parser.add_argument(
+        "--determine-packages",
+        action="store",
+        metavar="REPOSITORY",
+        help="Print the packages whose blueprints in the git repository REPOSITORY "
+        "changed since --base-ref, separated by spaces.",
+    )
+    parser.add_argument(
+        "--base-ref",
+        action="store",
+        default=os.environ.get("CI_MERGE_REQUEST_DIFF_BASE_SHA"),
+        help="The revision --determine-packages compares HEAD to, defaults to "
+        "CI_MERGE_REQUEST_DIFF_BASE_SHA.",
+    )
     parser.add_argument(
         "--setup",
         action="store_true",
@@ -384,6 +1589,11 @@ if __name__ == "__main__":
         default=[],
         help="The path to a configuration override.",
     )
+    parser.add_argument(
+        "--config-cache",
+        action="store",
+        help="A directory to store the parsed configuration in, used while the configuration and its inputs are unchanged.",
+    )
     parser.add_argument(
         "--variables",
         action="store",
@@ -396,6 +1606,171 @@ if __name__ == "__main__":
     parser.add_argument(
         "--print-targets", action="store_true", help="Print all available targets."
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        help="The number of targets to run in parallel, overrides General/Jobs.",
+    )
+    parser.add_argument(
+        "--persistent-worker",
+        action="store_true",
+        default=None,
+        help="Run all commands of a target in one long-lived Craft interpreter, overrides General/PersistentWorker.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the commands that already succeeded on a target in a previous run with the same commands and settings.",
+    )
+    parser.add_argument(
+        "--resource-log",
+        action="store",
+        help="Write the wall time, CPU time and peak memory of each command as JSON lines to this file.",
+    )
+    parser.add_argument(
+        "--compare-resources",
+        action="store",
+        metavar="PREVIOUS",
+        help="Report the commands that got slower or use more memory than in the resource log PREVIOUS.",
+    )
+    parser.add_argument(
+        "--resource-threshold",
+        type=float,
+        default=0.25,
+        help="The increase --compare-resources reports, 0.25 means 25%%.",
+    )
+    parser.add_argument(
+        "--command-timeout",
+        type=float,
+        help="Kill a command and everything it started after this many seconds.",
+    )
+    parser.add_argument(
+        "--target-timeout",
+        type=float,
+        help="Kill the commands of a target once they ran for this many seconds in total.",
+    )
+    failFast = parser.add_mutually_exclusive_group()
+    failFast.add_argument(
+        "--fail-fast",
+        action="store_true",
+        default=None,
+        dest="fail_fast",
+        help="Cancel the running and queued targets when a target fails, default for sequential runs.",
+    )
+    failFast.add_argument(
+        "--keep-going",
+        action="store_false",
+        dest="fail_fast",
+        help="Let the other targets finish when a target fails, default for parallel runs.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parseShard,
+        metavar="I/N",
+        help="Only run the I-th of N deterministic shards of the targets, I starts at 1.",
+    )
+    parser.add_argument(
+        "--shard-history",
+        action="store",
+        metavar="RESOURCE_LOG",
+        help="Balance the shards by the target durations in a previous --resource-log.",
+    )
+    parser.add_argument(
+        "--check-config",
+        action="store_true",
+        help="Report all values of the configuration with missing or cyclic references.",
+    )
+    parser.add_argument(
+        "--verify-environment",
+        action="store_true",
+        help="Report the targets whose environment differs from its snapshot, see General/EnvironmentSnapshot.",
+    )
+    parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="Remove stale roots, cache archives and build directories until the work directory is below General/DiskQuota.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print what --gc would remove.",
+    )
+    parser.add_argument(
+        "--memo",
+        action="store_true",
+        dest="memo",
+        default=None,
+        help="Skip targets whose inputs are unchanged since their last successful run, overrides General/Memo.",
+    )
+    parser.add_argument(
+        "--no-memo",
+        action="store_false",
+        dest="memo",
+        default=None,
+        help="Run the commands even on targets whose inputs are unchanged since their last successful run.",
+    )
+    parser.add_argument(
+        "--log-dir",
+        action="store",
+        help="Write the output of every target to its own log file in this directory, overrides General/LogDir.",
+    )
+    parser.add_argument(
+        "--compress-logs",
+        action="store_true",
+        default=None,
+        help="Compress the log files with gzip, overrides General/CompressLogs.",
+    )
+    parser.add_argument(
+        "--trace-file",
+        action="store",
+        help="Write the duration of the setup phases, targets and commands to this file, in the Chrome trace format.",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store",
+        metavar="SOCKET",
+        help="Run a job server on this Unix socket, jobs are submitted with --server and run with the environment of the client.",
+    )
+    parser.add_argument(
+        "--concurrent-jobs",
+        action="store",
+        type=int,
+        default=1,
+        help="The number of jobs the server runs at the same time.",
+    )
+    parser.add_argument(
+        "--agent",
+        action="store",
+        metavar="HOST:PORT",
+        help="Run a build agent listening on this address, see --agents. Coordinators authenticate with the key in CRAFTMASTER_AGENT_KEY, which is required unless the address is a loopback address.",
+    )
+    parser.add_argument(
+        "--agents",
+        action="store",
+        nargs="+",
+        metavar="HOST:PORT",
+        help="Distribute the targets to these build agents, overrides General/Agents.",
+    )
+    parser.add_argument(
+        "--distribute",
+        action="store_true",
+        help="Distribute the targets to the agents from General/Agents.",
+    )
+    parser.add_argument(
+        "--server",
+        action="store",
+        metavar="SOCKET",
+        help="Submit the run to the job server listening on this Unix socket.",
+    )
+    parser.add_argument(
+        "--priority",
+        action="store",
+        type=int,
+        default=0,
+        help="The priority of the job submitted with --server, higher runs first.",
+    )
     parser.add_argument(
         "-c",
         "--commands",
@@ -414,22 +1789,141 @@ if __name__ == "__main__":
 
         print(os.environ["CRAFT_PACKAGE"])
         exit(0)
+    if args.determine_packages:
+        master = CraftMaster.__new__(CraftMaster)
+        master.verbose = args.verbose
+        if not args.base_ref:
+            parser.error("--determine-packages requires --base-ref")
+        print(" ".join(master._changedPackages(args.determine_packages, args.base_ref)))
+        exit(0)
+    if args.serve:
+        # Unix sockets are not available everywhere
+        from Server import JobServer
+
+        server = JobServer(args.serve, CraftMaster, slots=args.concurrent_jobs)
+        print(f"Waiting for jobs on {args.serve}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(args.serve)
+        exit(0)
+    if args.agent:
+        from Agent import KEY_VARIABLE, AgentServer, parseAddress
+
+        agent = AgentServer(
+            parseAddress(args.agent),
+            CraftMaster,
+            key=os.environ.get(KEY_VARIABLE),
+        )
+        print(f"Waiting for targets on {args.agent}", file=sys.stderr)
+        try:
+            agent.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            agent.server_close()
+        exit(0)
     if not args.config:
-        parser.error("--config is required unless --determine-package is used")
+        parser.error(
+            "--config is required unless --determine-package or --determine-packages "
+            "is used"
+        )
     configs = [args.config]
     configs += args.config_override
-    master = CraftMaster(
-        configs,
-        args.commands,
-        args.variables,
-        args.targets,
-        setup=args.setup,
-        verbose=args.verbose,
-    )
-    if args.print_targets:
-        print("Targets:")
-        for target in master.targets:
-            print("\t", target)
-    else:
-        exit(master.run())
+    if args.check_config:
+        problems = Config(
+            [Path(x).absolute() for x in configs], args.variables
+        ).unresolved()
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        exit(1 if problems else 0)
+    if args.server:
+        from Server import submitJob
+
+        exit(
+            submitJob(
+                args.server,
+                {
+                    "configs": [str(Path(x).absolute()) for x in configs],
+                    "variables": args.variables,
+                    "targets": args.targets,
+                    "commands": args.commands,
+                    "setup": args.setup,
+                    "resume": args.resume,
+                    "memo": args.memo,
+                    "failFast": args.fail_fast,
+                    "commandTimeout": args.command_timeout,
+                    "targetTimeout": args.target_timeout,
+                    "jobs": args.jobs,
+                    "persistentWorker": args.persistent_worker,
+                    "logDir": args.log_dir and os.path.abspath(args.log_dir),
+                    "compressLogs": args.compress_logs,
+                    "priority": args.priority,
+                    "environ": dict(os.environ),
+                },
+                print,
+            )
+        )
+    trace = Trace(args.trace_file)
+    try:
+        master = CraftMaster(
+            configs,
+            args.commands,
+            args.variables,
+            args.targets,
+            setup=args.setup,
+            verbose=args.verbose,
+            jobs=args.jobs,
+            persistentWorker=args.persistent_worker,
+            configCache=args.config_cache,
+            trace=trace,
+            logDir=args.log_dir,
+            compressLogs=args.compress_logs,
+            resume=args.resume,
+            memo=args.memo,
+            failFast=args.fail_fast,
+            commandTimeout=args.command_timeout,
+            targetTimeout=args.target_timeout,
+            shard=args.shard,
+            shardHistory=args.shard_history,
+            resourceLog=args.resource_log and os.path.abspath(args.resource_log),
+            prepare=not (args.agents or args.distribute or args.gc),
+        )
+        if args.print_targets:
+            print("Targets:")
+            for target in master.targets:
+                print("\t", target)
+            if master.shards:
+                print("Shards:")
+                for index, shard in enumerate(master.shards, 1):
+                    current = " (this shard)" if index == master.shard[0] else ""
+                    print("\t", f"{index}/{len(master.shards)}{current}:", *shard)
+        elif args.gc:
+            master.collectGarbage(dryRun=args.dry_run)
+        elif args.verify_environment:
+            exit(master.verifyEnvironment())
+        elif args.agents or args.distribute:
+            exit(master.dispatch(args.agents))
+        else:
+            code = master.run()
+            if args.compare_resources:
+                master.reportResourceRegressions(
+                    args.compare_resources, args.resource_threshold
+                )
+            if master.config.getBool("General", "CollectGarbage", False):
+                master.collectGarbage(dryRun=args.dry_run)
+            exit(code)
+    finally:
+        trace.write()
     exit(0)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except CraftMasterError as e:
+        print(e, file=sys.stderr)
+        exit(1)
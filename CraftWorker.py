@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import runpy
+import secrets
+import subprocess
+import sys
+import traceback
+from multiprocessing.connection import Client, Listener
+
+from ProcessGroup import groupArgs, killGroup
+
+# marks the end of the output of a command, followed by its exit code
+_MARKER = b"\0craftmaster-worker "
+# bound the length of a line, craft might print progress without newlines
+_CHUNK = 64 * 1024
+
+
+def _partialMarker(data):
+    """Return the length of the start of the marker at the end of data."""
+    for length in range(min(len(_MARKER) - 1, len(data)), 0, -1):
+        if data.endswith(_MARKER[:length]):
+            return length
+    return 0
+
+
+class CraftWorker(object):
+    """A long-lived craft.py interpreter running several commands.
+
+    The commands are sent over a local socket, the output of the worker is
+    read from its stdout and passed line by line to output.
+    """
+
+    def __init__(self, craftPy, output, env=None, cpus=None):
+        self._output = output
+        key = secrets.token_bytes(32)
+        env = dict(os.environ if env is None else env)
+        env["CRAFTMASTER_WORKER_KEY"] = key.hex()
+        self._process = subprocess.Popen(
+            [sys.executable, "-X", "utf8", "-u", os.path.abspath(__file__), craftPy],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            **groupArgs(),
+        )
+        if cpus:
+            os.sched_setaffinity(self._process.pid, cpus)
+        self._connection = None
+        _, address = self._readOutput()
+        if address is None:
+            self.close()
+            raise OSError(f"Failed to start the craft worker for {craftPy}")
+        self._connection = Client(address, authkey=key)
+
+    def _readLine(self):
+        return self._process.stdout.readline(_CHUNK)
+
+    def _readOutput(self):
+        pending = b""
+        while True:
+            chunk = self._readLine()
+            if not chunk:
+                if pending:
+                    self._output(pending.decode("utf-8", errors="replace"))
+                return None, None
+            line, pending = pending + chunk, b""
+            index = line.find(_MARKER)
+            if index < 0:
+                if not line.endswith(b"\n"):
+                    # the marker might continue in the next chunk
+                    length = _partialMarker(line)
+                    if length:
+                        line, pending = line[:-length], line[-length:]
+                if line:
+                    self._output(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+                continue
+            if index > 0:
+                self._output(line[:index].decode("utf-8", errors="replace"))
+            line = line[index + len(_MARKER) :]
+            while not line.endswith(b"\n"):
+                chunk = self._readLine()
+                if not chunk:
+                    break
+                line += chunk
+            kind, value = line.decode("utf-8").split(" ", 1)
+            value = value.rstrip("\r\n")
+            return (int(value), None) if kind == "exit" else (None, value)
+
+    def run(self, args):
+        """Run craft.py with args and return its exit code."""
+        try:
+            self._connection.send(args)
+        except OSError:
+            return self._died()
+        returncode, _ = self._readOutput()
+        if returncode is None:
+            return self._died()
+        return returncode
+
+    def _died(self):
+        returncode = self._process.wait()
+        return returncode if returncode else 1
+
+    def kill(self):
+        """Kill the worker and everything it started, a running command fails."""
+        killGroup(self._process)
+
+    @property
+    def alive(self):
+        return self._process.poll() is None
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+        for line in iter(self._readLine, b""):
+            self._output(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+        self._process.stdout.close()
+        try:
+            self._process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+def _emit(kind, value):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.write(sys.stdout.fileno(), _MARKER + f"{kind} {value}\n".encode("utf-8"))
+
+
+def _runCraft(craftPy, args):
+    """Run craft.py like a fresh interpreter would and restore the state afterwards."""
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    argv = sys.argv
+    path = list(sys.path)
+    streams = sys.stdout, sys.stderr, sys.stdin
+    sys.argv = [craftPy] + args
+    try:
+        runpy.run_path(craftPy, run_name="__main__")
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout, sys.stderr, sys.stdin = streams
+        sys.argv = argv
+        sys.path[:] = path
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+
+
+def _serve(craftPy):
+    key = bytes.fromhex(os.environ.pop("CRAFTMASTER_WORKER_KEY"))
+    # like running craft.py directly
+    sys.path[0] = os.path.dirname(craftPy)
+    with Listener(authkey=key) as listener:
+        _emit("address", listener.address)
+        with listener.accept() as connection:
+            while True:
+                try:
+                    args = connection.recv()
+                except EOFError:
+                    return
+                _emit("exit", _runCraft(craftPy, args))
+
+
+if __name__ == "__main__":
+    _serve(sys.argv[1])
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+from FileLock import fileLock
+
+# checkouts and unfinished downloads are not stored
+_SKIP_DIRS = {".git", ".svn", ".hg"}
+_SKIP_SUFFIXES = (".part", ".partial", ".download", ".tmp")
+
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadStore(object):
+    """A content addressed store of the downloads of all roots of a builder.
+
+    Each root downloads into a directory of its own. After a target ran its new
+    downloads are moved into the store by their sha256 and replaced by hardlinks,
+    before a target runs the known downloads are linked into its directory.
+    """
+
+    # the file lock does not exclude threads on all platforms
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        self.index = os.path.join(path, "index.json")
+        os.makedirs(self.objects, exist_ok=True)
+
+    def _readIndex(self):
+        try:
+            with open(self.index, "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def objectPath(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _replace(self, src, dest):
+        """Atomically replace dest by a hardlink to src, or a copy across devices."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=".craftmaster-")
+        os.close(fd)
+        os.unlink(tmp)
+        try:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copy2(src, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def add(self, path):
+        """Store the file path and replace it by a link to the stored file."""
+        digest = fileDigest(path)
+        target = self.objectPath(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+            os.close(fd)
+            try:
+                shutil.copyfile(path, tmp)
+                # read-only objects are hardlinked into the roots
+                os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                # another writer might have stored the same content meanwhile
+                os.replace(tmp, target)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        self._replace(target, path)
+        return digest
+
+    def _stored(self, path, digest):
+        try:
+            return digest and os.path.samefile(path, self.objectPath(digest))
+        except OSError:
+            return False
+
+    def collect(self, downloadDir):
+        """Store the new downloads of a root, returns their names."""
+        index = self._readIndex()
+        added = {}
+        for directory, dirs, files in os.walk(downloadDir):
+            if _SKIP_DIRS & set(dirs):
+                # a checkout
+                dirs[:] = []
+                continue
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, downloadDir).replace(os.sep, "/")
+                if (
+                    name.endswith(_SKIP_SUFFIXES)
+                    or name.startswith(".craftmaster-")
+                    or os.path.islink(path)
+                    or self._stored(path, index.get(key))
+                ):
+                    continue
+                added[key] = self.add(path)
+        if added:
+            with DownloadStore._lock, fileLock(os.path.join(self.path, "lock")):
+                index = self._readIndex()
+                index.update(added)
+                fd, tmp = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(fd, "wt", encoding="utf-8") as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.index)
+        return sorted(added)
+
+    def populate(self, downloadDir):
+        """Link the stored downloads missing in downloadDir, returns their names."""
+        linked = []
+        for key, digest in sorted(self._readIndex().items()):
+            dest = os.path.join(downloadDir, *key.split("/"))
+            target = self.objectPath(digest)
+            if os.path.lexists(dest) or not os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            self._replace(target, dest)
+            linked.append(key)
+        return linked
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+
+class CraftMasterError(Exception):
+    """The base class of the errors raised by CraftMaster."""
+
+
+class ConfigError(CraftMasterError):
+    """The configuration or an option is invalid."""
+
+
+class CommandError(CraftMasterError):
+    """A command failed or timed out."""
+
+    def __init__(self, command, returncode, message=None):
+        self.command = command
+        self.returncode = returncode
+        super().__init__(
+            message or f"Command {command} failed with exit code: {returncode}"
+        )
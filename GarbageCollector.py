@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import shutil
+import stat
+
+
+def _removeReadonly(func, path, exc):
+    os.chmod(path, stat.S_IRWXU)
+    func(path)
+
+
+def _diskUsage(stats):
+    # st_blocks is not available on Windows
+    return getattr(stats, "st_blocks", 0) * 512 or stats.st_size
+
+
+def pathSize(path, seen=None, shared=True):
+    """The disk usage of path, symlinks are not followed.
+
+    Inodes in seen are only counted once. Without shared files that have other
+    links are skipped, removing them frees nothing.
+    """
+    if seen is None:
+        seen = set()
+    try:
+        stats = os.lstat(path)
+    except OSError:
+        return 0
+    if not stat.S_ISDIR(stats.st_mode):
+        if (stats.st_dev, stats.st_ino) in seen or (not shared and stats.st_nlink > 1):
+            return 0
+        seen.add((stats.st_dev, stats.st_ino))
+        return _diskUsage(stats)
+    size = _diskUsage(stats)
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                size += pathSize(entry.path, seen, shared)
+    except OSError:
+        pass
+    return size
+
+
+def lastUsed(path):
+    """The latest use of path or its direct children."""
+    paths = [path]
+    if os.path.isdir(path) and not os.path.islink(path):
+        with os.scandir(path) as entries:
+            paths += [x.path for x in entries]
+    times = []
+    for x in paths:
+        try:
+            stats = os.lstat(x)
+        except OSError:
+            continue
+        if stat.S_ISDIR(stats.st_mode):
+            # listing a directory, like the garbage collector does, updates its atime
+            times.append(stats.st_mtime)
+        else:
+            times.append(max(stats.st_atime, stats.st_mtime))
+    return max(times, default=0)
+
+
+class GarbageCollector(object):
+    """Frees disk space in a work directory until it is below quota.
+
+    Roots no longer used by a target are removed first, followed by cache
+    archives, downloads and build directories, the least recently used first.
+    """
+
+    def __init__(self, workDir, roots, quota, cacheDirs=(), buildDirs=(), log=print):
+        self.workDir = os.path.abspath(workDir)
+        self.roots = {os.path.abspath(x) for x in roots}
+        self.quota = quota
+        self.cacheDirs = sorted({os.path.abspath(x) for x in cacheDirs})
+        self.buildDirs = sorted({os.path.abspath(x) for x in buildDirs})
+        self.log = log
+
+    def _locations(self):
+        """The directories counted for the quota."""
+        locations = [self.workDir]
+        for directory in self.cacheDirs:
+            if not any(os.path.commonpath([directory, x]) == x for x in locations):
+                locations.append(directory)
+        return locations
+
+    def usage(self):
+        seen = set()
+        return sum(pathSize(x, seen) for x in self._locations())
+
+    def staleRoots(self):
+        """Directories that look like Craft roots but belong to no target."""
+        parents = {self.workDir} | {os.path.dirname(x) for x in self.roots}
+        stale = []
+        for parent in sorted(parents):
+            if not os.path.isdir(parent):
+                continue
+            for entry in os.scandir(parent):
+                if not entry.is_dir(follow_symlinks=False) or entry.path in self.roots:
+                    continue
+                if entry.name.endswith(".provisioning") or os.path.exists(
+                    os.path.join(entry.path, "etc", "CraftSettings.ini")
+                ):
+                    stale.append(entry.path)
+        return stale
+
+    def candidates(self):
+        """Return what can be removed in the order it should be removed."""
+        stale = sorted(self.staleRoots(), key=lastUsed)
+        others = []
+        for directory in self.cacheDirs:
+            for base, _, files in os.walk(directory):
+                others += [os.path.join(base, x) for x in files]
+        for directory in self.buildDirs:
+            # build/<category>/<package>
+            if os.path.isdir(directory):
+                for category in os.scandir(directory):
+                    if category.is_dir(follow_symlinks=False):
+                        others += [x.path for x in os.scandir(category.path)]
+        return stale + sorted(others, key=lastUsed)
+
+    def collect(self, dryRun=False):
+        """Remove candidates until the usage is below the quota.
+
+        Returns a list of the removed paths and the space they freed.
+        """
+        usage = self.usage()
+        removed = []
+        self.log(f"Disk usage {usage >> 20}MiB, quota {self.quota >> 20}MiB")
+        for path in self.candidates():
+            if usage <= self.quota:
+                break
+            if not os.path.lexists(path):
+                # part of a root removed before
+                continue
+            size = pathSize(path, shared=False)
+            self.log(
+                f"{'Would remove' if dryRun else 'Removing'} {path} ({size >> 20}MiB)"
+            )
+            if not dryRun:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, onerror=_removeReadonly)
+                else:
+                    os.unlink(path)
+            usage -= size
+            removed.append((path, size))
+        freed = sum(size for _, size in removed)
+        self.log(
+            f"{'Would free' if dryRun else 'Freed'} {freed >> 20}MiB in "
+            f"{len(removed)} paths, disk usage {usage >> 20}MiB"
+        )
+        if usage > self.quota:
+            self.log("Warning: Nothing left to remove, the quota is still exceeded")
+        return removed
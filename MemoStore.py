@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import json
+import os
+import threading
+
+
+class MemoStore(object):
+    """Remembers the input keys of successful target runs.
+
+    Only the maxEntries most recently used keys are kept.
+    """
+
+    # shared by the parallel targets
+    _lock = threading.Lock()
+
+    def __init__(self, path, maxEntries=1000):
+        self.path = path
+        self.maxEntries = maxEntries
+
+    def _read(self):
+        try:
+            with open(self.path, "rt", encoding="utf-8") as f:
+                return collections.OrderedDict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            return collections.OrderedDict()
+
+    def _write(self, entries):
+        while len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(list(entries.items()), f)
+        os.replace(tmp, self.path)
+
+    def __contains__(self, key):
+        with self._lock:
+            entries = self._read()
+            if key not in entries:
+                return False
+            entries.move_to_end(key)
+            self._write(entries)
+            return True
+
+    def add(self, key, target):
+        with self._lock:
+            entries = self._read()
+            entries[key] = target
+            entries.move_to_end(key)
+            self._write(entries)
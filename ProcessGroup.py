@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import signal
+import subprocess
+import threading
+
+# the time a process group gets to terminate before it is killed
+KILL_GRACE = 5
+
+
+def groupArgs():
+    """The Popen arguments that start a process in a process group of its own."""
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def killGroup(process, grace=KILL_GRACE):
+    """Terminate the process group of process and kill it after grace seconds.
+
+    Returns without waiting, reaping the process is up to the caller.
+    """
+    if os.name == "nt":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return
+
+    def send(sig):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    send(signal.SIGTERM)
+    timer = threading.Timer(grace, send, args=(signal.SIGKILL,))
+    timer.daemon = True
+    timer.start()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import json
+import os
+import sys
+import threading
+
+# differences below these are noise
+MIN_SECONDS = 1.0
+MIN_BYTES = 16 << 20
+
+
+def usageFromRusage(rusage):
+    """The CPU times and the peak RSS in bytes of a process and its reaped children."""
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "user": rusage.ru_utime,
+        "system": rusage.ru_stime,
+        "maxRss": rusage.ru_maxrss * scale,
+    }
+
+
+class ResourceLog(object):
+    """Appends the resource usage of each command as a JSON line to path.
+
+    The file holds one run, it is truncated by the first record so that runs
+    which execute no commands keep the previous log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.recorded = False
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        with self._lock:
+            mode = "at"
+            if not self.recorded:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                mode = "wt"
+            with open(self.path, mode, encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.recorded = True
+
+
+def readResourceLog(path):
+    """Return a dict of (target, command) to the last entry recorded for it."""
+    entries = {}
+    with open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entries[(entry["target"], entry["command"])] = entry
+    return entries
+
+
+def compareResourceLogs(previous, current, threshold=0.25):
+    """Compare the resource logs current and previous.
+
+    Returns a line for each command that got slower or used more memory by more
+    than threshold.
+    """
+    previous = readResourceLog(previous)
+    current = readResourceLog(current)
+    metrics = [
+        ("wall", "wall time", MIN_SECONDS, lambda x: f"{x:.1f}s"),
+        ("cpu", "CPU time", MIN_SECONDS, lambda x: f"{x:.1f}s"),
+        ("maxRss", "peak RSS", MIN_BYTES, lambda x: f"{x / (1 << 20):.0f}MiB"),
+    ]
+    regressions = []
+    for key, entry in sorted(current.items()):
+        old = previous.get(key)
+        if not old or old.get("exitCode") != 0 or entry.get("exitCode") != 0:
+            continue
+        for metric, name, minimum, toText in metrics:
+            if metric == "cpu":
+                before, after = [
+                    x["user"] + x["system"] if x.get("user") is not None else None
+                    for x in (old, entry)
+                ]
+            else:
+                before, after = old.get(metric), entry.get(metric)
+            if before is None or after is None:
+                continue
+            if after - before >= minimum and after > before * (1 + threshold):
+                regressions.append(
+                    f"{key[0]}: '{key[1]}' {name} {toText(before)} -> {toText(after)}"
+                )
+    return regressions
+
+
+def targetDurations(path):
+    """Return a dict of target to the wall time of its commands in a resource log."""
+    durations = {}
+    for (target, _), entry in readResourceLog(path).items():
+        durations[target] = durations.get(target, 0) + entry.get("wall", 0)
+    return durations
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import os
+import shutil
+import stat
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError("reflinks are not supported")
+    with open(src, "rb") as source, open(dest, "wb") as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            os.unlink(dest)
+            raise
+
+
+def cloneFile(src, dest):
+    """Copy src to dest sharing the data where possible.
+
+    Returns how the file was copied: reflink, hardlink or copy.
+    """
+    try:
+        _reflink(src, dest)
+        shutil.copystat(src, dest)
+        return "reflink"
+    except OSError:
+        pass
+    if not os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        try:
+            os.link(src, dest)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return "copy"
+
+
+def cloneTree(src, dest, skip=()):
+    """Clone the directory src to dest, skip are paths relative to src.
+
+    Returns a Counter of the ways the files were copied.
+    """
+    counts = collections.Counter()
+    skip = {os.path.normpath(x) for x in skip}
+    for directory, dirs, files in os.walk(src):
+        relDir = os.path.relpath(directory, src)
+        os.makedirs(os.path.join(dest, relDir), exist_ok=True)
+        # os.walk does not follow symlinks to directories, they are copied as links
+        links = [x for x in dirs if os.path.islink(os.path.join(directory, x))]
+        dirs[:] = [
+            x
+            for x in dirs
+            if x not in links and os.path.normpath(os.path.join(relDir, x)) not in skip
+        ]
+        for name in links + files:
+            relPath = os.path.normpath(os.path.join(relDir, name))
+            if relPath in skip:
+                continue
+            source = os.path.join(src, relPath)
+            target = os.path.join(dest, relPath)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                counts["symlink"] += 1
+            else:
+                counts[cloneFile(source, target)] += 1
+    for directory, _, _ in os.walk(dest, topdown=False):
+        relDir = os.path.relpath(directory, dest)
+        shutil.copystat(os.path.join(src, relDir), directory)
+    return counts
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import contextlib
+import os
+import threading
+
+
+class Reservation(object):
+    def __init__(self, cores, memory, exclusive, cpus):
+        self.cores = cores
+        self.memory = memory
+        self.exclusive = exclusive
+        # the cpus the target is pinned to, None without affinity
+        self.cpus = cpus
+
+
+class ResourceScheduler(object):
+    """Hands out cores and memory so the running targets never exceed the machine.
+
+    A target that needs more than the machine has gets all of it and runs alone.
+    """
+
+    def __init__(self, cores=None, memory=None, affinity=False):
+        self.cores = cores or os.cpu_count() or 1
+        if memory is None:
+            memory = ResourceScheduler.physicalMemory()
+        self.memory = memory
+        self._condition = threading.Condition()
+        self._usedCores = 0
+        self._usedMemory = 0
+        self._running = 0
+        self._exclusive = False
+        self._freeCpus = None
+        if affinity and hasattr(os, "sched_getaffinity"):
+            self._freeCpus = sorted(os.sched_getaffinity(0))
+
+    @staticmethod
+    def physicalMemory():
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    def _fits(self, reservation):
+        if self._exclusive or (reservation.exclusive and self._running):
+            return False
+        if self._usedCores + reservation.cores > self.cores:
+            return False
+        if self.memory is None:
+            return True
+        return self._usedMemory + reservation.memory <= self.memory
+
+    @contextlib.contextmanager
+    def reserve(self, cores=0, memory=0, exclusive=False):
+        reservation = Reservation(
+            min(cores, self.cores),
+            min(memory, self.memory) if self.memory is not None else memory,
+            exclusive,
+            None,
+        )
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(reservation))
+            self._usedCores += reservation.cores
+            self._usedMemory += reservation.memory
+            self._running += 1
+            self._exclusive = exclusive
+            if self._freeCpus is not None and reservation.cores:
+                reservation.cpus = self._freeCpus[: reservation.cores]
+                del self._freeCpus[: reservation.cores]
+        try:
+            yield reservation
+        finally:
+            with self._condition:
+                self._usedCores -= reservation.cores
+                self._usedMemory -= reservation.memory
+                self._running -= 1
+                self._exclusive = False
+                if reservation.cpus:
+                    self._freeCpus = sorted(self._freeCpus + reservation.cpus)
+                self._condition.notify_all()
+
+
+def shardTargets(targets, count, durations=None):
+    """Split targets into count shards, the same input always gives the same shards.
+
+    Without durations the sorted targets are dealt out by name. With durations, a
+    dict of target to seconds, the longest target goes to the shard with the least
+    total duration first. Targets without a duration count with the mean duration.
+    """
+    targets = sorted(targets)
+    shards = [[] for _ in range(count)]
+    known = [durations[x] for x in targets if x in durations] if durations else []
+    if not known:
+        for index, target in enumerate(targets):
+            shards[index % count].append(target)
+        return shards
+    mean = sum(known) / len(known)
+    estimates = {x: durations.get(x, mean) for x in targets}
+    totals = [0.0] * count
+    for target in sorted(targets, key=lambda x: (-estimates[x], x)):
+        index = min(range(count), key=lambda x: (totals[x], x))
+        shards[index].append(target)
+        totals[index] += estimates[target]
+    return [sorted(x) for x in shards]
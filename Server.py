@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import copy
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+from pathlib import Path
+
+from Config import Config
+from Errors import CraftMasterError
+
+
+def sendMessage(stream, message):
+    stream.write((json.dumps(message) + "\n").encode("utf-8"))
+    stream.flush()
+
+
+def readMessages(stream):
+    for line in stream:
+        yield json.loads(line)
+
+
+class JobQueue(object):
+    """Runs at most slots jobs at a time, by priority, and never two jobs on one root."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        self._waiting = []
+        self._busy = set()
+        self._running = 0
+
+    def _canRun(self, entry):
+        if self._running >= self.slots or entry[2] & self._busy:
+            return False
+        # a job that could run as well and was queued with a higher priority or earlier goes first
+        return not any(
+            other < entry and not other[2] & self._busy for other in self._waiting
+        )
+
+    def acquire(self, priority, roots):
+        entry = (-priority, next(self._counter), frozenset(roots))
+        with self._condition:
+            self._waiting.append(entry)
+            self._condition.wait_for(lambda: self._canRun(entry))
+            self._waiting.remove(entry)
+            self._busy |= entry[2]
+            self._running += 1
+        return entry
+
+    def release(self, entry):
+        with self._condition:
+            self._busy -= entry[2]
+            self._running -= 1
+            self._condition.notify_all()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            job = next(readMessages(self.rfile))
+        except (StopIteration, ValueError):
+            return
+        lock = threading.Lock()
+
+        def output(line):
+            with lock:
+                sendMessage(self.wfile, {"type": "output", "line": line})
+
+        try:
+            code = self.server.runJob(job, output)
+        except CraftMasterError as e:
+            output(str(e))
+            code = 1
+        except Exception as e:
+            output(f"Job failed: {e}")
+            code = 1
+        try:
+            sendMessage(self.wfile, {"type": "exit", "code": code or 0})
+        except OSError:
+            pass
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Accepts CraftMaster jobs on a Unix socket and keeps their setup warm.
+
+    A job is a dict with the configs, variables, targets and commands, the
+    environment of the client and an optional priority. Prepared CraftMaster
+    objects are reused as long as the config files and the environment
+    variables they refer to are unchanged.
+    """
+
+    # like socketserver.UnixStreamServer, which does not exist without AF_UNIX
+    address_family = getattr(socket, "AF_UNIX", None)
+    daemon_threads = True
+
+    def __init__(self, path, createMaster, slots=1):
+        self.createMaster = createMaster
+        self.queue = JobQueue(slots)
+        self._configs = {}
+        self._masters = {}
+        self._lock = threading.Lock()
+        self._setupLocks = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, JobHandler)
+
+    def _cached(self, cache, key, mtimes, create):
+        with self._lock:
+            cached = cache.get(key)
+        if cached and cached[0] == mtimes:
+            return cached[1]
+        value = create()
+        with self._lock:
+            cache[key] = (mtimes, value)
+        return value
+
+    @staticmethod
+    def _mtimes(job):
+        return [
+            os.stat(x).st_mtime_ns if os.path.exists(x) else None
+            for x in job["configs"]
+        ]
+
+    @staticmethod
+    def _environ(job):
+        """The environment of the client, the one of the server for older clients."""
+        return os.environ if job.get("environ") is None else job["environ"]
+
+    def _environKey(self, job):
+        """The variables of the client environment the configs refer to."""
+        environ = self._environ(job)
+        try:
+            names = Config.referencedEnvironment(job["configs"])
+        except OSError:
+            # Config reports the missing file
+            names = []
+        return {name: environ.get(name) for name in names}
+
+    def _config(self, job):
+        return self._cached(
+            self._configs,
+            json.dumps([job["configs"], job.get("variables"), self._environKey(job)]),
+            self._mtimes(job),
+            lambda: Config(
+                [Path(x) for x in job["configs"]],
+                job.get("variables"),
+                environ=self._environ(job),
+            ),
+        )
+
+    def _master(self, job, output):
+        def create():
+            workDir = self._config(job).get("Variables", "Root")
+            with self._lock:
+                setupLock = self._setupLocks.setdefault(workDir, threading.Lock())
+            # jobs on other roots of the work dir might update craft-clone as well
+            with setupLock:
+                return self.createMaster(
+                    job["configs"],
+                    None,
+                    job.get("variables"),
+                    job.get("targets"),
+                    setup=job.get("setup", False),
+                    outputHandler=output,
+                    environ=self._environ(job),
+                )
+
+        key = [
+            job["configs"],
+            job.get("variables"),
+            sorted(job.get("targets") or []),
+            job.get("setup", False),
+            self._environKey(job),
+        ]
+        return self._cached(self._masters, json.dumps(key), self._mtimes(job), create)
+
+    def runJob(self, job, output):
+        config = self._config(job)
+        roots = {config.rootDir(x) for x in job.get("targets") or config.targets}
+        entry = self.queue.acquire(job.get("priority", 0), roots)
+        try:
+            master = copy.copy(self._master(job, output))
+            master.outputHandler = output
+            # the commands run with the environment of this client
+            master.environ = self._environ(job)
+            master.commands = [job["commands"]] if job.get("commands") else []
+            master.jobs = job.get("jobs")
+            master.resume = job.get("resume", False)
+            master.memo = job.get("memo")
+            master.failFast = job.get("failFast")
+            master.commandTimeout = job.get("commandTimeout")
+            master.targetTimeout = job.get("targetTimeout")
+            master.logDir = job.get("logDir")
+            master.compressLogs = job.get("compressLogs")
+            master.persistentWorker = job.get("persistentWorker")
+            return master.run()
+        finally:
+            self.queue.release(entry)
+
+
+def submitJob(path, job, output):
+    """Send job to the server listening on path and return its exit code."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        with connection.makefile("rwb") as stream:
+            sendMessage(stream, job)
+            for message in readMessages(stream):
+                if message["type"] == "output":
+                    output(message["line"])
+                elif message["type"] == "exit":
+                    return message["code"]
+    output("The connection to the CraftMaster server was lost")
+    return 1
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import gzip
+import os
+
+
+class TargetLog(object):
+    """Writes the output of a target to a file and keeps only its last lines in memory."""
+
+    def __init__(self, path, compress=False, tailLines=50):
+        self.path = f"{path}.gz" if compress else path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if compress:
+            self._file = gzip.open(self.path, "wt", encoding="utf-8")
+        else:
+            self._file = open(self.path, "wt", encoding="utf-8")
+        self.tail = collections.deque(maxlen=tailLines)
+
+    def __call__(self, line):
+        self._file.write(line + "\n")
+        self.tail.append(line)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Trace(object):
+    """Records spans in the Chrome trace event format, readable by Perfetto.
+
+    Without a path all spans are ignored.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._events = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        return time.perf_counter_ns() // 1000
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the duration of the with block, args can be extended inside of it."""
+        if not self.path:
+            yield args
+            return
+        start = Trace._now()
+        try:
+            yield args
+        finally:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": Trace._now() - start,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def write(self):
+        if not self.path:
+            return
+        with self._lock:
+            events = list(self._events)
+        with open(self.path, "wt", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
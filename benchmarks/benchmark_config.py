@@ -0,0 +1,205 @@
+# SPDX-FileCopyrightText: 2026 agent <agent@local>
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Benchmarks Config and the settings generation with a synthetic matrix config.
+
+The results are written as JSON and can be compared to a stored baseline,
+a benchmark slower than the baseline by more than the threshold fails the run.
+Baselines are machine specific, regenerate them with --update-baseline.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Config import Config  # noqa: E402
+from CraftMaster import CraftMaster  # noqa: E402
+
+TEMPLATE = """
+[General]
+ABI =
+
+[Blueprints]
+Locations =
+
+[Compile]
+BuildType = Release
+"""
+
+
+def writeConfigs(directory: Path, targets, settings, depth, overrides):
+    """Write a main config and overrides, return their paths and the target names."""
+    prefix = Config.platformPrefix()
+    names = [f"{prefix}-target{i:04}-gcc" for i in range(targets)]
+    lines = ["[General]", "Branch = master", "", "[Variables]", "Level0 = base"]
+    lines += [f"Level{i} = ${{Variables:Level{i - 1}}}/{i}" for i in range(1, depth)]
+    last = f"${{Variables:Level{depth - 1}}}"
+    lines += ["", "[GeneralSettings]"]
+    lines += [f"Category{i % 50}/Key{i} = {last}/{i}" for i in range(settings)]
+    lines += ["", "[BlueprintSettings]"]
+    lines += [f"category{i % 50}/package{i}.version = {i}" for i in range(settings)]
+    for i, name in enumerate(names):
+        lines += [
+            "",
+            f"[{name}]",
+            f"General/ABI = {name}",
+            f"Compile/BuildType = {last}",
+            "",
+            f"[{name}-BlueprintSettings]",
+            f"category0/package{i}.version = {last}",
+        ]
+    files = [directory / "matrix.ini"]
+    files[0].write_text("\n".join(lines) + "\n", encoding="utf-8")
+    for o in range(overrides):
+        override = directory / f"override{o}.ini"
+        overrideLines = ["[GeneralSettings]"]
+        overrideLines += [
+            f"Category{i % 50}/Key{i} = ${{Variables:Level{o}}}/override"
+            for i in range(o, settings, 10)
+        ]
+        override.write_text("\n".join(overrideLines) + "\n", encoding="utf-8")
+        files.append(override)
+    return files, names
+
+
+def measure(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {"min": min(durations), "median": statistics.median(durations)}
+
+
+def runBenchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workDir = Path(tmp)
+        configFiles, names = writeConfigs(
+            workDir, args.targets, args.settings, args.depth, args.overrides
+        )
+        clone = workDir / "craft-clone"
+        (clone / "bin").mkdir(parents=True)
+        (clone / "craftenv.ps1").touch()
+        (clone / "CraftSettings.ini.template").write_text(TEMPLATE, encoding="utf-8")
+        variables = [f"Root={workDir}"]
+
+        results["Config.__init__"] = measure(
+            lambda: Config(configFiles, variables), args.repeat
+        )
+
+        config = Config(configFiles, variables)
+
+        def targets():
+            config._targets = None
+            return config.targets
+
+        results["Config.targets"] = measure(targets, args.repeat)
+
+        def get():
+            for name in names:
+                config.get("Settings", "Root", name, target=name)
+                config.get("General", "Branch", target=name)
+                config.get(name, "Compile/BuildType")
+
+        results["Config.get"] = measure(get, args.repeat)
+
+        master = CraftMaster.__new__(CraftMaster)
+        master.verbose = False
+        general = list(config.getSection("GeneralSettings"))
+        blueprints = list(config.getSection("BlueprintSettings"))
+        results["_setSetting"] = measure(
+            lambda: master._setSetting(general, Config.readIni()), args.repeat
+        )
+        results["_setBluePrintSettings"] = measure(
+            lambda: master._setBluePrintSettings(blueprints, Config.readIni()),
+            args.repeat,
+        )
+
+        def setConfig():
+            # drop the fingerprints to force the generation of all targets
+            for fingerprint in workDir.glob("*/etc/craftmaster_fingerprint"):
+                fingerprint.unlink()
+            with open(os.devnull, "wt") as devnull:
+                with contextlib.redirect_stderr(devnull):
+                    CraftMaster([str(x) for x in configFiles], None, variables, None)
+
+        results["_setConfig"] = measure(setConfig, args.repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print(f"{name}: {result['median']:.4f}s (no baseline)")
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        print(f"{name}: {result['median']:.4f}s ({ratio:.2f}x baseline)")
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="CraftMaster benchmarks")
+    parser.add_argument("--targets", type=int, default=100)
+    parser.add_argument("--settings", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=9)
+    parser.add_argument("--overrides", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results to this JSON file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="The allowed slowdown compared to the baseline, 0.5 means 50%%.",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing them.",
+    )
+    args = parser.parse_args()
+
+    results = runBenchmarks(args)
+    data = {
+        "parameters": {
+            "targets": args.targets,
+            "settings": args.settings,
+            "depth": args.depth,
+            "overrides": args.overrides,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "wt", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "wt", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+    elif args.baseline:
+        with open(args.baseline, "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != data["parameters"]:
+            print("The baseline was recorded with different parameters")
+            exit(1)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            exit(1)
+    else:
+        for name, result in sorted(results.items()):
+            print(f"{name}: {result['median']:.4f}s")
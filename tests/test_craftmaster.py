@@ -3,16 +3,135 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import contextlib
+import gzip
+import hashlib
 import io
 import json
 import os
+import signal
+import socketserver
 import subprocess
 import sys
 import tempfile
+import textwrap
+import threading
+import time
 import unittest
+from pathlib import Path
 from unittest import mock
 
+from Agent import AgentHandler, AgentServer
+from Config import Config
 from CraftMaster import CraftMaster
+from CraftWorker import CraftWorker
+from DownloadStore import DownloadStore
+from Errors import CommandError, ConfigError, CraftMasterError
+from GarbageCollector import GarbageCollector
+from MemoStore import MemoStore
+from ResourceLog import compareResourceLogs, readResourceLog
+from Scheduler import ResourceScheduler, shardTargets
+from Server import JobQueue, JobServer, submitJob
+from Trace import Trace
+
+FAKE_CRAFT = """
+import os
+import subprocess
+import sys
+import time
+# <root>/craft/bin/craft.py
+rootDir = os.path.dirname(os.path.dirname(os.path.dirname(sys.argv[0])))
+root = os.path.basename(rootDir)
+if "MAKEFLAGS" in os.environ:
+    print("makeflags " + os.environ["MAKEFLAGS"])
+if "FAKE_TOOLCHAIN" in os.environ:
+    print("toolchain " + os.environ["FAKE_TOOLCHAIN"])
+print("craft " + " ".join(sys.argv[1:]))
+print("pid", os.getpid())
+if "download" in sys.argv:
+    archive = os.path.join(rootDir, "download", "src.tar")
+    print("reused" if os.path.exists(archive) else "downloaded", archive)
+    os.makedirs(os.path.dirname(archive), exist_ok=True)
+    if not os.path.exists(archive):
+        with open(archive, "wt") as f:
+            f.write("source")
+if "hang-" + root in sys.argv:
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    print("child", child.pid, flush=True)
+    time.sleep(60)
+sys.exit(1 if "fail" in sys.argv or "fail-" + root in sys.argv else 0)
+"""
+
+TEMPLATE = """
+[General]
+ABI =
+
+[Blueprints]
+Locations =
+"""
+
+
+class CraftMasterTestCase(unittest.TestCase):
+    """Provides a work dir with a fake craft-clone and a config using it."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.workDir = Path(tmp.name)
+        clone = self.workDir / "craft-clone"
+        (clone / "bin").mkdir(parents=True)
+        (clone / "bin" / "craft.py").write_text(FAKE_CRAFT, encoding="utf-8")
+        (clone / "CraftSettings.ini.template").write_text(TEMPLATE, encoding="utf-8")
+        (clone / "craftenv.ps1").touch()
+        self.enterContext(contextlib.redirect_stderr(io.StringIO()))
+        # set when the tests run from make, the fake craft reports it
+        self.enterContext(mock.patch.dict(os.environ))
+        os.environ.pop("MAKEFLAGS", None)
+
+    def git(self, *args, cwd=None):
+        return subprocess.run(
+            ["git", "-c", "user.name=Test", "-c", "user.email=test@example.org"]
+            + list(args),
+            cwd=cwd,
+            check=True,
+            encoding="utf-8",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.strip()
+
+    def make_upstream(self):
+        """Turn the fake craft-clone into a bare repository standing in for Craft."""
+        source = self.workDir / "craft-source"
+        (self.workDir / "craft-clone").rename(source)
+        self.git("init", "-q", "-b", "master", cwd=source)
+        self.git("add", ".", cwd=source)
+        self.git("commit", "-q", "-m", "initial", cwd=source)
+        upstream = self.workDir / "upstream.git"
+        self.git("clone", "-q", "--bare", str(source), str(upstream))
+        return source, upstream
+
+    def commit(self, source, upstream, name):
+        (source / name).write_text(name, encoding="utf-8")
+        self.git("add", name, cwd=source)
+        self.git("commit", "-q", "-m", name, cwd=source)
+        self.git("push", "-q", str(upstream), "master", cwd=source)
+        return self.git("rev-parse", "HEAD", cwd=source)
+
+    def write_config(self, text, name="test.ini"):
+        config = self.workDir / name
+        config.write_text(textwrap.dedent(text), encoding="utf-8")
+        return str(config)
+
+    def target(self, name):
+        return f"{Config.platformPrefix()}-{name}"
+
+    def make_master(self, config, commands=None, targets=None, **kwargs):
+        return CraftMaster(
+            [config] if isinstance(config, str) else config,
+            commands,
+            [f"Root={self.workDir}"],
+            targets,
+            **kwargs,
+        )
 
 
 class CraftPackageExtractionTest(unittest.TestCase):
@@ -97,5 +216,1157 @@ class CraftPackageExtractionTest(unittest.TestCase):
         self.assertEqual(completed.stdout.strip(), "kcalc")
 
 
+class CraftMasterRunTest(CraftMasterTestCase):
+    def config(self):
+        return self.write_config(
+            f"""
+            [General]
+            Command = -i craft
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("b")}]
+            General/ABI = b
+            """
+        )
+
+    def test_parallel_run_prefixes_output_and_collects_exit_codes(self):
+        master = self.make_master(self.config(), commands=["-i", "fail"], jobs=2)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.run(), 1)
+        self.assertIn(f"[{self.target('a')}] craft -i fail", stdout.getvalue())
+        self.assertIn(f"[{self.target('b')}] craft -i fail", stdout.getvalue())
+
+    def test_jobs_are_read_from_config(self):
+        master = self.make_master(self.config(), commands=["-i", "ok"])
+        self.assertEqual(master._jobCount(), 1)
+        master.config._config.set("General", "Jobs", "4")
+        self.assertEqual(master._jobCount(), 4)
+        master.jobs = 2
+        self.assertEqual(master._jobCount(), 2)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.run(), 0)
+        self.assertEqual(stdout.getvalue().count("] craft -i ok"), 2)
+
+    def test_sequential_run_uses_config_commands(self):
+        master = self.make_master(self.config())
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.run(), 0)
+        self.assertNotIn("[", stdout.getvalue())
+
+    def test_persistent_worker_runs_all_commands_in_one_interpreter(self):
+        master = self.make_master(
+            self.config(), targets=[self.target("a")], jobs=2, persistentWorker=True
+        )
+        master.commands = [["-i", "one"], ["-i", "two"], ["-i", "fail"], ["-i", "x"]]
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master._exec(self.target("a"), master.commands, True), 1)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            [line for line in lines if " craft " in line],
+            [f"[{self.target('a')}] craft -i {c}" for c in ("one", "two", "fail")],
+        )
+        self.assertEqual(len({line for line in lines if " pid " in line}), 1)
+
+    def test_persistent_worker_bounds_lines_without_newline(self):
+        craftPy = self.workDir / "progress.py"
+        craftPy.write_text(
+            "import sys\nsys.stdout.write('x' * int(sys.argv[1]))\n", encoding="utf-8"
+        )
+        lines = []
+        worker = CraftWorker(str(craftPy), lines.append)
+        try:
+            # the marker starts in one chunk and ends in the next one
+            for length in [64 * 1024 - 5, 3 * 64 * 1024 + 7, 0]:
+                lines.clear()
+                self.assertEqual(worker.run([str(length)]), 0)
+                self.assertEqual("".join(lines), "x" * length)
+                self.assertLessEqual(max(map(len, lines), default=0), 64 * 1024)
+        finally:
+            worker.close()
+
+    def test_trace_file_contains_phases_targets_and_commands(self):
+        trace = Trace(self.workDir / "trace.json")
+        master = self.make_master(
+            self.config(), commands=["-i", "fail"], jobs=2, trace=trace
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            master.run()
+        trace.write()
+
+        events = json.loads(trace.path.read_text())["traceEvents"]
+        self.assertTrue(
+            {"config", "init", "roots", "settings"}.issubset(
+                {e["name"] for e in events if e["cat"] == "phase"}
+            )
+        )
+        commands = [e for e in events if e["cat"] == "command"]
+        self.assertEqual(
+            sorted(e["args"]["target"] for e in commands),
+            [self.target("a"), self.target("b")],
+        )
+        self.assertEqual({e["args"]["exitCode"] for e in commands}, {1})
+        self.assertEqual({e["args"]["command"] for e in commands}, {"-i fail"})
+
+    def test_output_is_logged_per_target_with_a_tail_on_failure(self):
+        master = self.make_master(
+            self.config(), commands=["-i", "fail"], jobs=2, logDir="logs"
+        )
+        master.config._config.set("General", "CompressLogs", "True")
+        master.config._config.set("General", "LogTailLines", "2")
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            with contextlib.redirect_stderr(stderr):
+                self.assertEqual(master.run(), 1)
+        self.assertEqual(stdout.getvalue(), "")
+
+        log = self.workDir / "logs" / f"{self.target('a')}.log.gz"
+        with gzip.open(log, "rt", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[:2], ["$ -i fail", "craft -i fail"])
+        self.assertIn(
+            f"Last 2 lines of {self.target('a')}, see {log}:\ncraft -i fail\npid ",
+            stderr.getvalue(),
+        )
+
+    def test_resume_skips_the_commands_that_already_succeeded(self):
+        target = self.target("a")
+        commands = [["-i", "one"], ["-i", "fail"]]
+
+        def run(commands, resume):
+            master = self.make_master(
+                self.config(), targets=[target], jobs=2, resume=resume
+            )
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                master._exec(target, commands, parallel=True)
+            return [
+                line for line in stdout.getvalue().splitlines() if " craft " in line
+            ]
+
+        self.assertEqual(len(run(commands, resume=False)), 2)
+        self.assertEqual(run(commands, resume=True), [f"[{target}] craft -i fail"])
+        self.assertEqual(len(run(commands + [["-i", "two"]], resume=True)), 2)
+        self.assertEqual(len(run(commands, resume=False)), 2)
+
+    def test_unchanged_targets_are_cached(self):
+        target = self.target("a")
+
+        def run(**kwargs):
+            master = self.make_master(self.config(), targets=[target], **kwargs)
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                master._exec(target, [["-i", "one"]], parallel=True)
+            return " craft " in stdout.getvalue()
+
+        with mock.patch.dict(os.environ, {"CRAFT_PACKAGE": "kate"}):
+            self.assertTrue(run(memo=True))
+            self.assertFalse(run(memo=True))
+            self.assertIn(f"Skipping {target}, it is cached", sys.stderr.getvalue())
+            # memoization is opt-in
+            self.assertTrue(run())
+            self.assertTrue(run(memo=False))
+            os.environ["CRAFT_PACKAGE"] = "kcalc"
+            self.assertTrue(run(memo=True))
+
+        store = MemoStore(str(self.workDir / "memo.json"), maxEntries=2)
+        store.add("a", target)
+        store.add("b", target)
+        self.assertIn("a", store)
+        store.add("c", target)
+        self.assertNotIn("b", store)
+        self.assertIn("a", store)
+        self.assertIn("c", store)
+
+    def test_resource_usage_is_recorded_and_compared(self):
+        log = self.workDir / "resources.jsonl"
+        log.write_text("previous run\n", encoding="utf-8")
+        master = self.make_master(
+            self.config(), commands=["-i", "one"], resourceLog=str(log)
+        )
+        self.assertEqual(log.read_text(encoding="utf-8"), "previous run\n")
+        master = self.make_master(
+            self.config(), commands=["-i", "one"], jobs=2, resourceLog=str(log)
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(master.run(), 0)
+        entries = readResourceLog(log)
+        self.assertEqual(
+            sorted(entries),
+            [(self.target("a"), "-i one"), (self.target("b"), "-i one")],
+        )
+        for entry in entries.values():
+            self.assertEqual(entry["exitCode"], 0)
+            self.assertGreater(entry["wall"], 0)
+            self.assertGreater(entry["maxRss"], 0)
+
+        def write(name, wall, maxRss):
+            path = self.workDir / name
+            entry = {"target": "t", "command": "-i x", "exitCode": 0, "wall": wall}
+            entry.update(user=wall, system=0, maxRss=maxRss)
+            path.write_text(json.dumps(entry) + "\n", encoding="utf-8")
+            return path
+
+        previous = write("previous.jsonl", 10, 100 << 20)
+        self.assertEqual(
+            compareResourceLogs(previous, write("same.jsonl", 11, 110 << 20)), []
+        )
+        self.assertEqual(
+            compareResourceLogs(previous, write("slower.jsonl", 20, 200 << 20)),
+            [
+                "t: '-i x' wall time 10.0s -> 20.0s",
+                "t: '-i x' CPU time 10.0s -> 20.0s",
+                "t: '-i x' peak RSS 100MiB -> 200MiB",
+            ],
+        )
+
+    def alive(self, pid):
+        try:
+            with open(f"/proc/{pid}/stat", "rt") as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except FileNotFoundError:
+            return False
+
+    def children(self, output):
+        return [int(x.split()[-1]) for x in output.splitlines() if " child " in x]
+
+    @unittest.skipUnless(sys.platform == "linux", "requires /proc")
+    def test_timed_out_commands_are_killed_with_their_children(self):
+        a = self.target("a")
+        master = self.make_master(
+            self.config(), commands=["-i", f"hang-{a}"], jobs=2, commandTimeout=0.5
+        )
+        stdout = io.StringIO()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.run(), 1)
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual(master.results[a]["status"], "timed out")
+        self.assertEqual(master.results[self.target("b")]["status"], "succeeded")
+        self.assertIn(f"Target {a} timed out", sys.stderr.getvalue())
+        [child] = self.children(stdout.getvalue())
+        for _ in range(50):
+            if not self.alive(child):
+                break
+            time.sleep(0.1)
+        self.assertFalse(self.alive(child))
+
+    @unittest.skipUnless(sys.platform == "linux", "requires /proc")
+    def test_signals_kill_the_running_commands(self):
+        a, b = self.target("a"), self.target("b")
+        for signum, error in [
+            (signal.SIGINT, KeyboardInterrupt),
+            (signal.SIGTERM, SystemExit),
+        ]:
+            master = self.make_master(
+                self.config(), commands=["-i", f"hang-{a}", f"hang-{b}"], jobs=2
+            )
+            stdout = io.StringIO()
+
+            def interrupt():
+                # wait for both targets to start their child
+                while len(self.children(stdout.getvalue())) < 2:
+                    time.sleep(0.05)
+                os.kill(os.getpid(), signum)
+
+            threading.Thread(target=interrupt, daemon=True).start()
+            start = time.monotonic()
+            with contextlib.redirect_stdout(stdout):
+                with self.assertRaises(error):
+                    master.run()
+            self.assertLess(time.monotonic() - start, 30)
+            self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+            children = self.children(stdout.getvalue())
+            for _ in range(50):
+                if not any(self.alive(x) for x in children):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(any(self.alive(x) for x in children))
+
+    @unittest.skipUnless(sys.platform == "linux", "requires /proc")
+    def test_signals_are_left_to_the_handler_of_the_host(self):
+        a, b = self.target("a"), self.target("b")
+        received = []
+
+        def host(signum, frame):
+            received.append(signum)
+
+        previous = signal.signal(signal.SIGTERM, host)
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+        master = self.make_master(
+            self.config(), commands=["-i", f"hang-{a}", f"hang-{b}"], jobs=2
+        )
+        stdout = io.StringIO()
+
+        def interrupt():
+            while len(self.children(stdout.getvalue())) < 2:
+                time.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Thread(target=interrupt, daemon=True).start()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(stdout):
+            self.assertNotEqual(master.run(), 0)
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual(received, [signal.SIGTERM])
+        self.assertIs(signal.getsignal(signal.SIGTERM), host)
+
+    def test_fail_fast_cancels_running_and_queued_targets(self):
+        a, b, c = self.target("a"), self.target("b"), self.target("c")
+        config = self.write_config(
+            f"""
+            [{a}]
+            General/ABI = a
+
+            [{b}]
+            General/ABI = b
+
+            [{c}]
+            General/ABI = c
+            """
+        )
+        commands = ["-i", f"hang-{a}", f"fail-{b}"]
+        master = self.make_master(config, commands=commands, jobs=2, failFast=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(master.run(), 1)
+        self.assertEqual(
+            {x: master.results[x]["status"] for x in [a, b, c]},
+            {a: "cancelled", b: "failed", c: "cancelled"},
+        )
+        self.assertIn(f"Target {b} failed with exit code: 1", sys.stderr.getvalue())
+        self.assertIn(f"Target {a} cancelled", sys.stderr.getvalue())
+
+        master = self.make_master(
+            config, commands=["-i", f"fail-{a}"], jobs=1, failFast=False
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(master.run(), 1)
+        self.assertEqual(master.results[c]["status"], "succeeded")
+
+    def test_library_use_raises_errors_and_returns_results(self):
+        with self.assertRaises(ConfigError) as e:
+            self.make_master(self.config(), targets=[self.target("c")])
+        self.assertIn(
+            f"Target {self.target('c')} is not a valid target", str(e.exception)
+        )
+        with self.assertRaises(ConfigError):
+            self.make_master(str(self.workDir / "missing.ini"))
+
+        a = self.target("a")
+        master = self.make_master(
+            self.config(), prepare=False, logDir="logs", outputHandler=print
+        )
+        self.assertEqual(master.craftRoots, {})
+        master.prepare()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = master.runTarget(a, [["-i", "fail"]])
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual(result["exitCode"], 1)
+        self.assertGreater(result["duration"], 0)
+        self.assertEqual(result["log"], str(self.workDir / "logs" / f"{a}.log"))
+        self.assertEqual(master.runTarget(a)["status"], "succeeded")
+
+        # a cancelled run does not cancel the later targets
+        master.failFast = True
+        master.commands = [["-i", "fail"]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(master.run(), 1)
+            self.assertEqual(master.runTarget(a, [["-i", "ok"]])["status"], "succeeded")
+
+        with self.assertRaises(CommandError) as e:
+            master._run([sys.executable, "-c", "raise SystemExit(3)"])
+        self.assertEqual(e.exception.returncode, 3)
+
+
+class ResourceSchedulerTest(CraftMasterTestCase):
+    def test_targets_wait_for_free_cores_and_memory(self):
+        scheduler = ResourceScheduler(cores=4, memory=8)
+        started = []
+
+        def run(name, **kwargs):
+            with scheduler.reserve(**kwargs):
+                started.append(name)
+
+        with scheduler.reserve(cores=3, memory=2):
+            thread = threading.Thread(target=run, args=("big",), kwargs={"cores": 2})
+            thread.start()
+            run("small", cores=1, memory=6)
+            thread.join(0.1)
+            self.assertEqual(started, ["small"])
+        thread.join()
+        self.assertEqual(started, ["small", "big"])
+
+        with scheduler.reserve(cores=1):
+            thread = threading.Thread(
+                target=run, args=("exclusive",), kwargs={"exclusive": True}
+            )
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(started, ["small", "big"])
+        thread.join()
+        with scheduler.reserve(cores=100, memory=100) as reservation:
+            self.assertEqual((reservation.cores, reservation.memory), (4, 8))
+
+    def test_reserved_cores_are_passed_to_the_target(self):
+        config = self.write_config(
+            f"""
+            [General]
+            Command = -i craft
+            Cores = 4
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("a")}-Settings]
+            Cores = 2
+            Memory = 1G
+
+            [{self.target("b")}]
+            General/ABI = b
+            """
+        )
+        master = self.make_master(config, jobs=0)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.run(), 0)
+        self.assertIn(f"[{self.target('a')}] makeflags -j2", stdout.getvalue())
+        self.assertNotIn(f"[{self.target('b')}] makeflags", stdout.getvalue())
+        settings = Config.readIni(
+            Path(master.craftRoots[self.target("a")]) / "etc" / "CraftSettings.ini"
+        )
+        self.assertEqual(settings["Compile"]["Jobs"], "2")
+        self.assertEqual(Config.parseSize("1.5G"), 3 << 29)
+
+    def test_unweighted_targets_reserve_one_core(self):
+        names = "abcd"
+        config = self.write_config(
+            "[General]\nCores = 2\n"
+            + "".join(f"[{self.target(x)}]\nGeneral/ABI = {x}\n" for x in names)
+        )
+        master = self.make_master(config, commands=["-i", "ok"], jobs=0)
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def execTarget(target, args, parallel=False, reservation=None):
+            with lock:
+                running.append(target)
+                peak.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.remove(target)
+            master.results[target] = master._result("succeeded", 0)
+            return 0
+
+        master._exec = execTarget
+        self.assertEqual(master.run(), 0)
+        self.assertEqual(max(peak), 2)
+
+
+class ShardTest(CraftMasterTestCase):
+    def test_shards_are_deterministic_and_balanced_by_duration(self):
+        targets = ["a", "b", "c", "d", "e"]
+        self.assertEqual(
+            shardTargets(reversed(targets), 2), [["a", "c", "e"], ["b", "d"]]
+        )
+        self.assertEqual(shardTargets(["a"], 3), [["a"], [], []])
+        durations = {"a": 100, "b": 60, "c": 50, "d": 10}
+        self.assertEqual(
+            shardTargets(targets, 2, durations), [["a", "c"], ["b", "d", "e"]]
+        )
+
+    def test_only_the_targets_of_the_shard_are_set_up(self):
+        a, b, c = self.target("a"), self.target("b"), self.target("c")
+        config = self.write_config(
+            f"""
+            [{a}]
+            General/ABI = a
+
+            [{b}]
+            General/ABI = b
+
+            [{c}]
+            General/ABI = c
+            """
+        )
+        history = self.workDir / "resources.jsonl"
+        history.write_text(
+            "".join(
+                json.dumps({"target": t, "command": "-i x", "wall": w}) + "\n"
+                for t, w in [(a, 10), (b, 100), (c, 20)]
+            ),
+            encoding="utf-8",
+        )
+        master = self.make_master(config, shard=(1, 2))
+        self.assertEqual(master.shards, [[a, c], [b]])
+        self.assertEqual(sorted(master.craftRoots), [a, c])
+        master = self.make_master(config, shard=(2, 2), shardHistory=str(history))
+        self.assertEqual(master.shards, [[b], [a, c]])
+        self.assertEqual(sorted(master.craftRoots), [a, c])
+        master = self.make_master(config, commands=["-i", "x"], shard=(4, 4))
+        self.assertEqual(master.craftRoots, {})
+        self.assertEqual(master.run(), 0)
+
+
+class JobServerTest(CraftMasterTestCase):
+    def test_jobs_are_run_by_priority_without_sharing_roots(self):
+        queue = JobQueue(slots=2)
+        running = queue.acquire(0, {"a"})
+        order = []
+
+        def submit(priority, roots):
+            entry = queue.acquire(priority, roots)
+            order.append(priority)
+            queue.release(entry)
+
+        threads = [
+            threading.Thread(target=submit, args=(priority, {"a"}))
+            for priority in (1, 5)
+        ]
+        for thread in threads:
+            thread.start()
+            while len(queue._waiting) < threads.index(thread) + 1:
+                time.sleep(0.01)
+        queue.release(queue.acquire(0, {"b"}))
+        self.assertEqual(order, [])
+        queue.release(running)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [5, 1])
+
+    def test_submitted_jobs_stream_output_and_exit_code(self):
+        config = self.write_config(
+            f"""
+            [{self.target("a")}]
+            General/ABI = a
+            """
+        )
+        socketPath = str(self.workDir / "server.socket")
+        server = JobServer(socketPath, CraftMaster)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        job = {
+            "configs": [config],
+            "variables": [f"Root={self.workDir}"],
+            "commands": ["-i", "fail"],
+        }
+        for _ in range(2):
+            lines = []
+            self.assertEqual(submitJob(socketPath, job, lines.append), 1)
+            self.assertIn("craft -i fail", lines)
+        self.assertEqual(len(server._masters), 1)
+
+        job["commands"] = ["-i", "ok"]
+        lines = []
+        self.assertEqual(submitJob(socketPath, job, lines.append), 0)
+        self.assertIn("craft -i ok", lines)
+
+    def test_jobs_run_with_the_environment_of_the_client(self):
+        config = self.write_config(
+            f"""
+            [{self.target("a")}]
+            General/ABI = ${{Env:FAKE_ABI}}
+            """
+        )
+        socketPath = str(self.workDir / "server.socket")
+        server = JobServer(socketPath, CraftMaster)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        for abi, toolchain in [("a", "first"), ("a", "second"), ("b", "third")]:
+            job = {
+                "configs": [config],
+                "variables": [f"Root={self.workDir}"],
+                "commands": ["-i", "ok"],
+                "environ": dict(os.environ, FAKE_ABI=abi, FAKE_TOOLCHAIN=toolchain),
+            }
+            lines = []
+            self.assertEqual(submitJob(socketPath, job, lines.append), 0)
+            self.assertIn(f"toolchain {toolchain}", lines)
+            self.assertEqual(
+                server._config(job).get(self.target("a"), "General/ABI"),
+                abi,
+            )
+        self.assertEqual(len(server._configs), 2)
+        self.assertEqual(len(server._masters), 2)
+
+
+class DispatchTest(CraftMasterTestCase):
+    def start(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+        return f"{host}:{port}"
+
+    def test_targets_of_a_dead_agent_are_rescheduled(self):
+        class DyingAgent(AgentHandler):
+            def handle(self):
+                # dies once it received a target
+                if self._challenge():
+                    self.rfile.read(1)
+
+        config = self.write_config(
+            f"""
+            [General]
+            Command = -i craft
+            KeyWithoutValue
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("b")}]
+            General/ABI = b
+
+            [{self.target("c")}]
+            General/ABI = c
+            """
+        )
+        # the agents on this host set up the same work dir one after the other
+        dying = socketserver.TCPServer(("127.0.0.1", 0), DyingAgent)
+        dying.key = None
+        agents = [
+            self.start(dying),
+            self.start(AgentServer(("127.0.0.1", 0), CraftMaster)),
+            self.start(AgentServer(("127.0.0.1", 0), CraftMaster)),
+        ]
+        master = self.make_master(config, prepare=False)
+        self.assertEqual(master.craftRoots, {})
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(master.dispatch(agents), 0)
+        for name in "abc":
+            self.assertIn(f"[{self.target(name)}] craft -i craft", stdout.getvalue())
+
+    def test_agents_require_the_key(self):
+        with self.assertRaises(CraftMasterError):
+            AgentServer(("0.0.0.0", 0), CraftMaster)
+        agent = self.start(AgentServer(("127.0.0.1", 0), CraftMaster, key="secret"))
+        for key, code in [("wrong", 1), (None, 1), ("secret", 0)]:
+            agentKey = f"AgentKey = {key}" if key else ""
+            config = self.write_config(
+                f"""
+                [General]
+                Command = -i craft
+                {agentKey}
+
+                [{self.target("a")}]
+                General/ABI = a
+                """
+            )
+            master = self.make_master(config, prepare=False)
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    self.assertEqual(master.dispatch([agent]), code)
+            if code:
+                self.assertIn("authentication failed", stderr.getvalue())
+                self.assertNotIn("craft -i craft", stdout.getvalue())
+            else:
+                self.assertIn("craft -i craft", stdout.getvalue())
+
+
+class SettingsFingerprintTest(CraftMasterTestCase):
+    def config(self, abi="b"):
+        return self.write_config(
+            f"""
+            [GeneralSettings]
+            Compile/BuildType = Release
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("b")}]
+            General/ABI = {abi}
+            """
+        )
+
+    def test_unchanged_settings_keep_the_blueprint_cache(self):
+        master = self.make_master(self.config())
+        caches = {}
+        for target, root in master.craftRoots.items():
+            caches[target] = Path(root) / "etc" / "cache.pickle"
+            caches[target].touch()
+
+        self.make_master(self.config())
+        self.assertTrue(all(cache.exists() for cache in caches.values()))
+
+        self.make_master(self.config(abi="c"))
+        self.assertTrue(caches[self.target("a")].exists())
+        self.assertFalse(caches[self.target("b")].exists())
+        settings = Config.readIni(
+            Path(master.craftRoots[self.target("b")]) / "etc" / "CraftSettings.ini"
+        )
+        self.assertEqual(settings["General"]["ABI"], "c")
+
+    def test_shared_settings_are_built_once(self):
+        readIni = Config.readIni
+        with mock.patch.object(Config, "readIni", side_effect=readIni) as read:
+            master = self.make_master(self.config())
+        templates = [x for x in read.call_args_list if x.args]
+        self.assertEqual(len(templates), 1)
+        for target, abi in [(self.target("a"), "a"), (self.target("b"), "b")]:
+            settings = Config.readIni(
+                Path(master.craftRoots[target]) / "etc" / "CraftSettings.ini"
+            )
+            self.assertEqual(settings["General"]["ABI"], abi)
+            self.assertEqual(settings["Compile"]["BuildType"], "Release")
+
+
+class TemplateRootTest(CraftMasterTestCase):
+    def test_new_roots_are_cloned_from_the_template_root(self):
+        config = self.write_config(
+            f"""
+            [General]
+            TemplateRoot = {self.target("a")}
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("b")}]
+            General/ABI = b
+            """
+        )
+        master = self.make_master(config, targets=[self.target("a")])
+        template = Path(master.craftRoots[self.target("a")])
+        (template / "bin").mkdir()
+        (template / "bin" / "tool").write_text("tool", encoding="utf-8")
+        (template / "bin" / "tool").chmod(0o555)
+        (template / "lib").mkdir()
+        (template / "lib" / "libx.so.1").write_text("libx", encoding="utf-8")
+        (template / "lib" / "libx.so").symlink_to("libx.so.1")
+        (template / "etc" / "install.db").write_text("db", encoding="utf-8")
+
+        with mock.patch("RootTemplate._reflink", side_effect=OSError):
+            master = self.make_master(config, targets=[self.target("b")])
+        root = Path(master.craftRoots[self.target("b")])
+        self.assertTrue((root / "bin" / "tool").samefile(template / "bin" / "tool"))
+        self.assertFalse(
+            (root / "lib" / "libx.so.1").samefile(template / "lib" / "libx.so.1")
+        )
+        self.assertEqual(os.readlink(root / "lib" / "libx.so"), "libx.so.1")
+        self.assertEqual((root / "etc" / "install.db").read_text(), "db")
+        self.assertTrue((root / "craft").samefile(self.workDir / "craft-clone"))
+        settings = Config.readIni(root / "etc" / "CraftSettings.ini")
+        self.assertEqual(settings["General"]["ABI"], "b")
+
+
+class EnvironmentSnapshotTest(CraftMasterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.helper = self.workDir / "craft-clone" / "bin" / "CraftSetupHelper.py"
+        self.write_helper("/opt/toolchain")
+
+    def write_helper(self, toolchain):
+        self.helper.write_text(
+            textwrap.dedent(
+                f"""
+                import os
+                with open(os.path.join("etc", "captures"), "at") as f:
+                    f.write("capture\\n")
+                print("FAKE_TOOLCHAIN={toolchain}")
+                print("PATH=" + os.environ["PATH"])
+                """
+            ),
+            encoding="utf-8",
+        )
+
+    def config(self, buildType="Release"):
+        return self.write_config(
+            f"""
+            [General]
+            EnvironmentSnapshot = True
+
+            [GeneralSettings]
+            Compile/BuildType = {buildType}
+
+            [{self.target("a")}]
+            General/ABI = a
+            """
+        )
+
+    def run_master(self, config):
+        lines = []
+        master = self.make_master(
+            config, commands=["-i", "x"], outputHandler=lines.append
+        )
+        self.assertEqual(master.run(), 0)
+        return master, lines
+
+    def test_commands_use_the_stored_environment_until_the_settings_change(self):
+        master, lines = self.run_master(self.config())
+        self.assertIn("toolchain /opt/toolchain", lines)
+        captures = Path(master.craftRoots[self.target("a")]) / "etc" / "captures"
+        snapshot = json.loads(
+            (captures.parent / "craftmaster_environment.json").read_text()
+        )
+        self.assertEqual(snapshot["environment"], {"FAKE_TOOLCHAIN": "/opt/toolchain"})
+
+        self.run_master(self.config())
+        self.assertEqual(captures.read_text(), "capture\n")
+        self.run_master(self.config(buildType="Debug"))
+        self.assertEqual(captures.read_text(), "capture\n" * 2)
+
+        self.write_helper("/opt/other")
+        lines.clear()
+        self.assertEqual(master.verifyEnvironment(), 1)
+        self.assertIn("FAKE_TOOLCHAIN: '/opt/toolchain' -> '/opt/other'", lines[0])
+
+
+class DownloadStoreTest(CraftMasterTestCase):
+    def test_downloads_are_stored_once_and_linked_into_the_roots(self):
+        config = self.write_config(
+            f"""
+            [General]
+            DownloadStore = downloads
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{self.target("b")}]
+            General/ABI = b
+            """
+        )
+        lines = []
+        master = self.make_master(
+            config, commands=["-i", "download"], jobs=1, outputHandler=lines.append
+        )
+        self.assertEqual(master.run(), 0)
+        self.assertEqual(
+            [x.split()[0] for x in lines if "src.tar" in x], ["downloaded", "reused"]
+        )
+        archives = [
+            Path(master.craftRoots[x]) / "download" / "src.tar"
+            for x in [self.target("a"), self.target("b")]
+        ]
+        store = DownloadStore(str(self.workDir / "downloads"))
+        digest = hashlib.sha256(b"source").hexdigest()
+        self.assertEqual(json.loads(Path(store.index).read_text()), {"src.tar": digest})
+        for archive in archives:
+            self.assertTrue(archive.samefile(store.objectPath(digest)))
+            settings = Config.readIni(
+                archive.parent.parent / "etc" / "CraftSettings.ini"
+            )
+            self.assertEqual(settings["Paths"]["DownloadDir"], str(archive.parent))
+
+        # a broken download is replaced, the stored file is untouched
+        archives[0].unlink()
+        archives[0].write_text("other", encoding="utf-8")
+        (archives[0].parent / "src.tar.part").write_text("partial", encoding="utf-8")
+        self.assertEqual(store.collect(str(archives[0].parent)), ["src.tar"])
+        self.assertEqual(Path(store.objectPath(digest)).read_text(), "source")
+        self.assertEqual(store.collect(str(archives[0].parent)), [])
+
+
+class GarbageCollectorTest(CraftMasterTestCase):
+    def test_stale_roots_and_least_recently_used_files_are_removed(self):
+        other = "android" if Config.platformPrefix() != "android" else "linux"
+        config = f"""
+            [General]
+            DiskQuota = {{quota}}
+            TemplateRoot = golden
+
+            [{self.target("a")}]
+            General/ABI = a
+
+            [{other}-b]
+            General/ABI = b
+            """
+        master = self.make_master(self.write_config(config.format(quota="1T")))
+        root = Path(master.craftRoots[self.target("a")])
+
+        def write(path, age):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"x" * (1 << 20))
+            for x in [path, path.parent, path.parent.parent]:
+                os.utime(x, (age, age))
+            return path.parent
+
+        stale = self.workDir / f"{self.target('old')}"
+        write(stale / "etc" / "CraftSettings.ini", 3000)
+        # the root of another platform and the template root are kept
+        kept = [self.workDir / f"{other}-b", self.workDir / "golden"]
+        for path in kept:
+            write(path / "etc" / "CraftSettings.ini", 500)
+        kate = write(root / "build" / "kde" / "kate" / "work" / "file", 1000).parent
+        archive = write(root / "download" / "archive.tar", 2000) / "archive.tar"
+        kcalc = write(root / "build" / "kde" / "kcalc" / "work" / "file", 4000).parent
+        usage = GarbageCollector(self.workDir, [root], 0).usage()
+
+        quota = usage - (5 << 19)
+        master = self.make_master(
+            self.write_config(config.format(quota=quota)), prepare=False
+        )
+        removed = [path for path, _ in master.collectGarbage(dryRun=True)]
+        self.assertEqual(removed, [str(stale), str(kate), str(archive)])
+        self.assertTrue(all(Path(x).exists() for x in removed))
+
+        master.collectGarbage()
+        self.assertFalse(any(Path(x).exists() for x in removed))
+        self.assertTrue(kcalc.exists())
+        self.assertTrue(root.exists())
+        self.assertTrue(all(path.exists() for path in kept))
+        self.assertLessEqual(GarbageCollector(self.workDir, [root], 0).usage(), quota)
+
+
+class ChangedPackagesTest(CraftMasterTestCase):
+    def test_maps_changed_blueprint_files_to_packages(self):
+        repository = self.workDir / "blueprints"
+        blueprints = [
+            "kde/kate/kate.py",
+            "kde/kcalc/kcalc.py",
+            "libs/qt/qtbase/qtbase.py",
+        ]
+        for path in blueprints:
+            (repository / path).parent.mkdir(parents=True)
+            (repository / path).write_text("", encoding="utf-8")
+        (repository / "README").write_text("", encoding="utf-8")
+        self.git("init", "-q", "-b", "master", cwd=repository)
+        self.git("add", ".", cwd=repository)
+        self.git("commit", "-q", "-m", "initial", cwd=repository)
+        base = self.git("rev-parse", "HEAD", cwd=repository)
+        (repository / "kde/kate/patches").mkdir()
+        (repository / "kde/kate/patches/fix.diff").write_text("", encoding="utf-8")
+        (repository / "libs/qt/qtbase/qtbase.py").write_text("#", encoding="utf-8")
+        (repository / "README").write_text("changed", encoding="utf-8")
+        self.git("add", ".", cwd=repository)
+        self.git("commit", "-q", "-m", "change", cwd=repository)
+
+        master = CraftMaster.__new__(CraftMaster)
+        master.verbose = False
+        self.assertEqual(master._changedPackages(repository, base), ["kate", "qtbase"])
+        self.assertEqual(master._changedPackages(repository, "HEAD"), [])
+
+
+class ConfigSnapshotTest(CraftMasterTestCase):
+    def load(self, config):
+        return Config(
+            [Path(config)], ["Root=/work"], snapshotDir=self.workDir / "cache"
+        )
+
+    def test_snapshot_is_used_while_the_config_is_unchanged(self):
+        config = self.write_config(
+            """
+            [Variables]
+            Cache = ${Root}/cache
+
+            [GeneralSettings]
+            Packager/CacheDir = ${Variables:Cache}
+            Paths/Home = ${Env:HOME}
+            """
+        )
+        self.assertEqual(
+            self.load(config).get("GeneralSettings", "Packager/CacheDir"),
+            "/work/cache",
+        )
+        with mock.patch.object(Config, "_read") as read:
+            snapshot = self.load(config)
+        read.assert_not_called()
+        self.assertEqual(
+            dict(snapshot.getSection("GeneralSettings")),
+            {"Packager/CacheDir": "/work/cache", "Paths/Home": os.environ["HOME"]},
+        )
+
+        with mock.patch.dict(os.environ, {"HOME": "/elsewhere"}):
+            self.assertEqual(
+                self.load(config).get("GeneralSettings", "Paths/Home"), "/elsewhere"
+            )
+
+    def test_failing_to_write_the_snapshot_is_logged(self):
+        config = self.write_config(
+            """
+            [General]
+            Branch = master
+            """
+        )
+        (self.workDir / "cache").touch()
+        lines = []
+        loaded = Config(
+            [Path(config)], [], snapshotDir=self.workDir / "cache", log=lines.append
+        )
+        self.assertEqual(loaded.get("General", "Branch"), "master")
+        self.assertEqual(len(lines), 1)
+        self.assertIn("Failed to write the config snapshot", lines[0])
+        self.assertEqual(sys.stderr.getvalue(), "")
+
+    def test_corrupt_snapshot_is_rebuilt(self):
+        config = self.write_config(
+            """
+            [General]
+            Branch = master
+            """
+        )
+        self.load(config)
+        (snapshot,) = (self.workDir / "cache").iterdir()
+        snapshot.write_text("{", encoding="utf-8")
+        self.assertEqual(self.load(config).get("General", "Branch"), "master")
+        self.assertEqual(
+            json.loads(snapshot.read_text())["resolved"]["General"],
+            {"Branch": "master"},
+        )
+
+
+class ConfigInterpolationTest(CraftMasterTestCase):
+    def test_values_are_resolved_once_and_errors_reported_together(self):
+        config = Config(
+            [
+                Path(
+                    self.write_config(
+                        """
+                        [Variables]
+                        Cache = ${Root}/cache
+                        Price = 5$$
+
+                        [GeneralSettings]
+                        Packager/CacheDir = ${Variables:Cache}/archives
+                        Paths/Price = ${Variables:Price}
+
+                        [General]
+                        Missing = ${Variables:Nope}
+                        A = ${B}
+                        B = ${A}
+                        """
+                    )
+                )
+            ],
+            ["Root=/work"],
+        )
+        self.assertEqual(
+            config.getSection("GeneralSettings"),
+            [("Packager/CacheDir", "/work/cache/archives"), ("Paths/Price", "5$")],
+        )
+        self.assertEqual(
+            config.unresolved(),
+            [
+                "[General] Missing: ${Variables:Nope} does not exist",
+                "[General] A: cyclic reference [General] A -> [General] B -> "
+                "[General] A",
+                "[General] B: cyclic reference [General] A -> [General] B -> "
+                "[General] A",
+            ],
+        )
+        with self.assertRaises(ConfigError):
+            config.get("General", "A")
+
+        config._config.set("Variables", "Nope", "${Cache}")
+        self.assertEqual(config.get("General", "Missing"), "/work/cache")
+
+
+class CraftMirrorTest(CraftMasterTestCase):
+    def config(self, upstream, revision=""):
+        return self.write_config(
+            f"""
+            [General]
+            CraftUrl = {upstream}
+            CraftMirror = mirror.git
+            CraftRevision = {revision}
+
+            [{self.target("a")}]
+            General/ABI = a
+            """
+        )
+
+    def test_craft_clone_is_a_worktree_of_the_shared_mirror(self):
+        source, upstream = self.make_upstream()
+        self.make_master(self.config(upstream))
+        clone = self.workDir / "craft-clone"
+        self.assertTrue((clone / ".git").is_file())
+        self.assertTrue((self.workDir / "mirror.git" / "HEAD").is_file())
+
+        revision = self.commit(source, upstream, "update")
+        self.make_master(self.config(upstream, revision))
+        self.assertEqual(self.git("rev-parse", "HEAD", cwd=clone), revision)
+        self.assertTrue((clone / "update").is_file())
+
+    def test_work_dirs_share_the_mirror_concurrently(self):
+        _, upstream = self.make_upstream()
+        mirror = self.workDir / "shared.git"
+        config = self.write_config(
+            f"""
+            [General]
+            CraftUrl = {upstream}
+            CraftMirror = {mirror}
+
+            [{self.target("a")}]
+            General/ABI = a
+            """
+        )
+        roots = [self.workDir / f"root{i}" for i in range(4)]
+        errors = []
+
+        def setUp(root):
+            try:
+                CraftMaster([config], None, [f"Root={root}"], None)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=setUp, args=(root,)) for root in roots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for root in roots:
+            self.assertTrue((root / "craft-clone" / "bin" / "craft.py").is_file())
+        self.assertFalse(Path(f"{mirror}.cloning").exists())
+
+
+class FetchRevisionTest(CraftMasterTestCase):
+    def config(self, upstream, revision):
+        return self.write_config(
+            f"""
+            [General]
+            CraftUrl = file://{upstream}
+            CraftRevision = {revision}
+            FetchRevisionOnly = True
+            SparseCheckout = bin
+
+            [{self.target("a")}]
+            General/ABI = a
+            """
+        )
+
+    def pinned_upstream(self):
+        source, upstream = self.make_upstream()
+        (source / "docs").mkdir()
+        revision = self.commit(source, upstream, "docs/index")
+        latest = self.commit(source, upstream, "update")
+        return upstream, revision, latest
+
+    def test_only_the_pinned_revision_is_fetched(self):
+        upstream, revision, latest = self.pinned_upstream()
+        self.git("config", "uploadpack.allowReachableSHA1InWant", "true", cwd=upstream)
+        self.make_master(self.config(upstream, revision))
+        clone = self.workDir / "craft-clone"
+        self.assertEqual(self.git("rev-parse", "HEAD", cwd=clone), revision)
+        self.assertTrue((clone / ".git" / "shallow").is_file())
+        self.assertFalse((clone / "docs").exists())
+        self.assertTrue((clone / "bin" / "craft.py").is_file())
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.git("cat-file", "-e", latest, cwd=clone)
+
+    def test_refused_fetch_falls_back_to_a_full_fetch(self):
+        upstream, revision, latest = self.pinned_upstream()
+        # protocol v2 always allows fetching a reachable commit
+        environment = {
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": "protocol.version",
+            "GIT_CONFIG_VALUE_0": "0",
+        }
+        with mock.patch.dict(os.environ, environment):
+            self.make_master(self.config(upstream, revision))
+        clone = self.workDir / "craft-clone"
+        self.assertEqual(self.git("rev-parse", "HEAD", cwd=clone), revision)
+        self.git("cat-file", "-e", latest, cwd=clone)
+
+
 if __name__ == "__main__":
     unittest.main()